@@ -1,5 +1,21 @@
+from threading import Thread, Event, Lock, BoundedSemaphore, local
+from Queue import Queue, Empty
+from time import time
+from email.utils import parsedate_tz, mktime_tz
+from uuid import uuid4
+import logging
+import random
+import re
+import json
+import redis
+
 from lib.revent import ReventClient
 from producer import Producer
+from flow_control import get_flow_control
+from entity_endpoint_tracker import RedisEndpoint, record_cache
+from metrics import registry, MetricsServer
+
+log = logging.getLogger(__name__)
 
 
 # build an app which has a web UI / API for managing
@@ -8,15 +24,247 @@ from producer import Producer
 
 NS = 'revent_broadcaster'
 
+REDIS_HOST = 'localhost'
+
+# what we expose on /metrics, per subscription and consumer url
+delivered_events = registry.counter(
+        '%s_events_total' % NS,
+        'events sent, by the class of their status code (2xx .. 5xx, error)',
+        ('subscription', 'consumer_url', 'status_class'))
+retried_events = registry.counter(
+        '%s_retries_total' % NS,
+        'events scheduled to be retried',
+        ('subscription', 'consumer_url'))
+removed_subscriptions = registry.counter(
+        '%s_removals_total' % NS,
+        'subscriptions removed because the consumer answered 410',
+        ('subscription', 'consumer_url'))
+delivery_latency = registry.histogram(
+        '%s_delivery_latency_seconds' % NS,
+        'time for the consumer to answer a send',
+        ('subscription', 'consumer_url'))
+queue_wait = registry.histogram(
+        '%s_queue_wait_seconds' % NS,
+        'time events wait in the handler (lanes, batching) before sending',
+        ('subscription', 'consumer_url'))
+handler_threads = registry.gauge(
+        '%s_handler_threads' % NS,
+        'running subscription handler and delivery lane threads')
+change_lag = registry.histogram(
+        '%s_change_lag_seconds' % NS,
+        'time from hearing of a subscription change to syncing it')
+
+def get_status_class(status_code):
+    """
+    returns the status code's class for our metrics, 2xx .. 5xx
+    or error if we didn't get a response
+    """
+    if not status_code:
+        return 'error'
+    return '%dxx' % (status_code // 100)
+
+class RetryScheduler:
+    """
+    keeps events which failed to send ordered by the time
+    they should next be tried
+    """
+
+    def __init__(self, base_delay=5, max_delay=60 * 30):
+        # first retry waits around base_delay seconds, each one
+        # after doubles that, never going past max_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempts, retry_after=None):
+        """
+        returns how many seconds to wait before the next attempt.
+        capped exponential backoff w/ jitter so that a consumer
+        coming back up doesn't get all it's retries at once
+        """
+
+        # if the consumer told us when to come back, listen, but
+        # not so far out that it could park the event for days
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        returns the seconds from a Retry-After header, which is
+        either a number of seconds or an HTTP date. None if bad
+        """
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time())
+
+    def schedule(self, event_data, attempts, delay):
+        """
+        stores the event to be tried again in delay seconds
+        """
+        raise NotImplementedError
+
+    def get_due(self, limit=100):
+        """
+        leases and returns the (event_data, attempts, lease) who's
+        retry time has passed. A leased retry stays stored, it's due
+        again if it isn't done before the lease runs out
+        """
+        raise NotImplementedError
+
+    def done(self, lease):
+        """
+        drops the leased retry, it's been taken care of
+        """
+        raise NotImplementedError
+
+    def get_next_time(self):
+        """
+        returns the time the next retry is due, None if
+        there are none
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        drops all the waiting retries
+        """
+        raise NotImplementedError
+
+class RedisRetryScheduler(RetryScheduler):
+    """
+    stores retries in a redis sorted set scored by the
+    time they are due
+    """
+
+    # how long a handler has to send a retry it took before it's
+    # due again (seconds). Covers the rate limit wait and the send
+    lease_timeout = 60 * 5
+
+    # grab the due retries and push them out by the lease timeout in
+    # one shot so that two handlers never send the same retry. they
+    # are only removed once sent, a handler dying mid send can't
+    # lose them
+    lease_due_script = """
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                           'LIMIT', 0, ARGV[2])
+    for i, member in ipairs(due) do
+        redis.call('ZADD', KEYS[1], ARGV[3], member)
+    end
+    return due
+    """
+
+    def __init__(self, rc, subscription_key, *args, **kwargs):
+        RetryScheduler.__init__(self, *args, **kwargs)
+        self.rc = rc
+        self.key = '%s:subscription:%s:retries' % (NS, subscription_key)
+        self.lease_due = self.rc.register_script(self.lease_due_script)
+
+    def schedule(self, event_data, attempts, delay):
+        # the id keeps identical events from colliding in the set
+        member = json.dumps({'id': uuid4().hex,
+                             'attempts': attempts,
+                             'event': event_data})
+        self.rc.zadd(self.key, {member: time() + delay})
+
+    def get_due(self, limit=100):
+        now = time()
+        due = self.lease_due(keys=[self.key],
+                             args=[now, limit, now + self.lease_timeout])
+        for member in due:
+            retry = json.loads(member)
+            # the member itself is the lease
+            yield retry['event'], retry['attempts'], member
+
+    def done(self, lease):
+        self.rc.zrem(self.key, lease)
+
+    def get_next_time(self):
+        first = self.rc.zrange(self.key, 0, 0, withscores=True)
+        if not first:
+            return None
+        return first[0][1]
+
+    def clear(self):
+        self.rc.delete(self.key)
+
+class EventFilter:
+    """
+    matches event names against a subscription's enabled events.
+    Enabled events are plain names, or patterns where * matches
+    anything (user.*). Plain names are a set lookup, only the
+    patterns go through a regex
+    """
+
+    def __init__(self, enabled_events):
+        self.names = set()
+        patterns = []
+        for event in enabled_events:
+            if '*' in event:
+                patterns.append(re.escape(event).replace('\\*', '.*'))
+            else:
+                self.names.add(event)
+
+        self.regex = None
+        if patterns:
+            self.regex = re.compile('^(?:%s)$' % '|'.join(patterns))
+
+        # the same thing as one regex string, for revent to filter
+        # the channel by. built once here, not per event
+        self.filter_string = '^(?:%s)$' % '|'.join(
+                                [re.escape(n) for n in sorted(self.names)]
+                                + patterns)
+
+    def matches(self, event_name):
+        """
+        True if the event name is one of our enabled events
+        """
+        if event_name in self.names:
+            return True
+        return bool(self.regex and self.regex.match(event_name))
+
 class SubscriptionHandler(Thread):
 
     timeout = 60
-    # after receiving a bad response from the client
-    # how long do we wait before trying the event agian
-    retry_frequency = 60 * 1 # = 1 min
-    # how long should we sleep if the client
-    # throws an error ?
-    fail_sleep_time = 60.0 * .5 # 30 seconds
+    # after failing to send an event we retry it later, backing
+    # off exponentially from retry_base_delay up to retry_max_delay
+    # seconds. None retries forever
+    retry_base_delay = 5
+    retry_max_delay = 60 * 30 # 30 min
+    max_retry_attempts = None
+    # http connection settings, handlers sending to the
+    # same consumer host share one connection pool
+    http_pool_size = 10
+    http_keep_alive = True
+    http_connect_timeout = 5
+    http_read_timeout = 30
+    # longest we'll wait for the consumer's rate limit to let us
+    # send (seconds). Past this the event is put off to the retry
+    # scheduler rather than held, unverified, past revent's timeout
+    max_send_wait = 30
+    # sends slower than this (seconds), and well past the consumer's
+    # usual latency, slow the rate down. None only lets failures
+    # and 429s slow it down
+    target_latency = 1.0
+    # how many events to send per request, 1 sends them
+    # one at a time. Batches go out when full or once the
+    # first event has waited batch_linger_time seconds
+    batch_size = 1
+    batch_linger_time = 0.5
+    # how many events can be out to the consumer at once. If
+    # ordered, events w/ the same name are always sent one after
+    # the other (retries aside), otherwise in any order
+    max_in_flight = 1
+    ordered = True
 
     def __init__(self, is_stopping,
                        subscription_key, consumer_url,
@@ -32,70 +280,446 @@ class SubscriptionHandler(Thread):
         self.subscription_key = subscription_key
         self.consumer_url = consumer_url
         self.domain = domain
-        self.producer = Producer(self.consumer_url,
-                                 self.domain)
+
+        # the label values our metrics are recorded under
+        self.metric_labels = (subscription_key, consumer_url)
+
+        # each thread sending for us gets it's own producer
+        # (they all share the host's connection pool)
+        self.thread_local = local()
+
+        # circuit breaker and send rate for our consumer, shared
+        # w/ any other handlers sending to it
+        self.flow_control = get_flow_control(self.consumer_url)
 
         # get the details of our subscription
+        # (builds our event filter)
         self.enabled_events = enabled_events
 
+        # tracks events waiting to be retried, setup by
+        # the implementation
+        self.retry_scheduler = None
+
+        # counts of how our deliveries went
+        self.stats = {}
+        self.stats_lock = Lock()
+
+        # if we're sending more than one event at a time these
+        # are the threads doing the sending, and the count of
+        # how many more we can have out
+        self.lanes = []
+        self.in_flight = BoundedSemaphore(self.max_in_flight)
+
+    def get_enabled_events(self):
+        return self._enabled_events
+
+    def set_enabled_events(self, enabled_events):
+        # the filter is only rebuilt when the events change
+        self._enabled_events = set(enabled_events or [])
+        self.event_filter = EventFilter(self._enabled_events)
+
+    enabled_events = property(get_enabled_events, set_enabled_events)
+
+    def get_producer(self):
+        """
+        returns the current thread's producer
+        """
+        producer = getattr(self.thread_local, 'producer', None)
+        if producer is None:
+            producer = Producer(self.consumer_url,
+                                self.domain,
+                                pool_size=self.http_pool_size,
+                                keep_alive=self.http_keep_alive,
+                                connect_timeout=self.http_connect_timeout,
+                                read_timeout=self.http_read_timeout)
+            self.thread_local.producer = producer
+        return producer
+
+    producer = property(get_producer)
+
     def run(self):
         """
         sit on the revent queue for the subscription
         passing events as HTTP(S) requests
         """
 
+        # if we can have more than one event out, start
+        # up the lanes which will be sending them
+        if self.max_in_flight > 1:
+            self.start_lanes()
+
+        try:
+            self.deliver_events()
+        finally:
+            self.stop_lanes()
+
+    def deliver_events(self):
+        """
+        loop getting events and sending them out until stopped
+        """
+
         # loop waiting for event data
         while not self.is_stopping.is_set():
 
-            # try and get an event
-            event_data = self.get_event()
+            # first send any events who's retry is due
+            self.send_due_retries()
+
+            # if we're batching send as many as we can at once
+            if self.batch_size > 1:
+                events = self.get_events()
+                if events:
+                    self.handle_events(events)
+                continue
+
+            # try and get an event, not waiting past our next retry
+            event_data = self.get_event(timeout=self.get_wait_timeout())
 
             # if didn't get one just go back around
             if event_data is None:
                 continue
 
-            # we got an event, broadcast it to our consumer
+            self.dispatch_event(event_data)
+
+    def start_lanes(self):
+        """
+        starts a delivery lane for each event we can have out
+        """
+        for i in xrange(self.max_in_flight):
+            lane = DeliveryLane(self)
+            lane.start()
+            self.lanes.append(lane)
+
+    def stop_lanes(self):
+        """
+        waits for the lanes to finish what they have
+        """
+        # the lanes have their own flag, we may be stopping
+        # because delivering blew up rather than being told to
+        for lane in self.lanes:
+            lane.is_stopping.set()
+        for lane in self.lanes:
+            lane.join()
+        self.lanes = []
+
+    def dispatch_event(self, event_data, attempts=0, lease=None):
+        """
+        sends the event, handing it off to a lane if we're sending
+        more than one at a time. Blocks while the window is full.
+        lease is the retry scheduler's lease if it's a retry
+        """
+
+        if not self.lanes:
+            # it goes straight out, no waiting
+            queue_wait.observe(self.metric_labels, 0)
+            status_code = self.handle_event(event_data, attempts)
+            self.finish_retry(lease)
+            return status_code
+
+        # wait for room in the window
+        self.in_flight.acquire()
+
+        # same names go down the same lane to keep their order
+        if self.ordered:
+            name = event_data.get('_name') or ''
+            lane = self.lanes[hash(name) % len(self.lanes)]
+        else:
+            lane = min(self.lanes, key=lambda l: l.queue.qsize())
+        lane.queue.put((event_data, attempts, time(), lease))
+
+    def get_events(self):
+        """
+        collects up to batch_size events, waiting no longer than
+        the linger time for the batch to fill after the first
+        """
+
+        # wait as normal for the first event
+        event_data = self.get_event(timeout=self.get_wait_timeout())
+        if event_data is None:
+            return []
+
+        events = [event_data]
+        received_at = [time()]
+        linger_until = received_at[0] + self.batch_linger_time
+        while len(events) < self.batch_size:
+            remaining = linger_until - time()
+            if remaining <= 0:
+                break
+            event_data = self.get_event(timeout=remaining)
+            if event_data is None:
+                break
+            events.append(event_data)
+            received_at.append(time())
+
+        # each event waited for the batch to fill behind it
+        now = time()
+        for at in received_at:
+            queue_wait.observe(self.metric_labels, now - at)
+
+        return events
+
+    def send_event(self, event_data):
+        """
+        pushes the event to our consumer, returns the
+        status code or None if the request failed
+        """
+        producer = self.producer
+        producer.last_response = None
+
+        started_at = time()
+        try:
+            status_code = producer.send_event(data=event_data)
+        except Exception, ex:
+            # woops, the event will be requeued
+            print 'exception sending event: %s' % ex
             status_code = None
-            try:
-                status_code = self.producer.send_event(data=event_data)
-            except Exception, ex:
-                # woops, the event will be requeued
-                print 'exception sending event: %s' % ex
 
-            # check the status code
+        latency = time() - started_at
+        self.flow_control.record(latency, status_code, self.target_latency)
+        delivery_latency.observe(self.metric_labels, latency)
+        return status_code
 
-            # if it's 410 (gone) than we want to remove the subscriber
-            if status_code and status_code == 410:
-                # will cancel retry as part of removing
-                self.remove_subscription()
+    def send_events(self, events):
+        """
+        pushes a batch of events to our consumer, returns the
+        status code and the per event status codes
+        """
+        producer = self.producer
+        producer.last_response = None
 
-            # we want to retry if we get a 500 series error
-            elif status_code and status_code in (500,503,504):
-                # TODO: respect 503 retry after times
-                # take no action and we'll retry after the timeout
-                self.fail_sleep()
+        started_at = time()
+        try:
+            status_code, item_statuses = producer.send_events(events)
+        except Exception, ex:
+            # woops, the events will be requeued
+            print 'exception sending events: %s' % ex
+            status_code, item_statuses = None, None
 
-            # a 200 is success, verify that we've send the msg
-            elif status_code and 200 <= status_code < 300:
-                self.verify_event_processed(event_name, event_data)
+        latency = time() - started_at
+        self.flow_control.record(latency, status_code, self.target_latency)
+        delivery_latency.observe(self.metric_labels, latency)
+        return status_code, item_statuses
 
-            # if we had an unknown exception (didn't get a status code)
-            # than we'll let it re-queue
-            elif not status_code:
-                pass
+    def wait_for_send_slot(self):
+        """
+        waits until the consumer's rate limit lets us send. returns
+        0 once we can, or the seconds until we could if that's
+        more than max_send_wait
+        """
+        delay = self.flow_control.limiter.reserve(self.max_send_wait)
+        if delay > self.max_send_wait:
+            return delay
+        if delay > 0:
+            self.is_stopping.wait(delay)
+        return 0
+
+    def check_circuit(self):
+        """
+        returns 0 if the consumer's circuit lets us send, else
+        the seconds to wait before trying
+        """
+        breaker = self.flow_control.breaker
+        if breaker.allow():
+            return 0
+        return breaker.get_retry_delay() or self.retry_base_delay
 
-            # if the status code didn't get caught already
-            # than we don't want to retry. Not sure what the best action
-            # would be here, maybe wait a super long retry time to give
-            # them recovery time?
-            else:
+    def check_send(self):
+        """
+        returns 0 once we can send to the consumer, pacing ourselves
+        to what it can take. else the seconds to put the send off
+        """
+        delay = self.check_circuit()
+        if delay:
+            return delay
+
+        delay = self.wait_for_send_slot()
+        if delay:
+            # the circuit may have let us through as it's probe
+            self.flow_control.breaker.release()
+        return delay
+
+    def handle_event(self, event_data, attempts=0):
+        """
+        broadcasts the event to our consumer and takes action
+        based on the response's status code. attempts is how many
+        times we've already tried the event
+        """
+
+        # if the consumer is down or backed up don't pile on, try later
+        delay = self.check_send()
+        if delay:
+            self.defer_event(event_data, attempts, delay)
+            return None
+
+        # we got an event, broadcast it to our consumer
+        status_code = self.send_event(event_data)
+
+        self.handle_status(event_data, status_code, attempts,
+                           self.get_retry_after())
+
+        return status_code
+
+    def handle_events(self, events):
+        """
+        broadcasts a batch of events to our consumer, taking action
+        for each event based on it's status. Only the events which
+        failed are scheduled to be retried
+        """
+
+        # if the consumer is down or backed up don't pile on, try later
+        delay = self.check_send()
+        if delay:
+            for event_data in events:
+                self.defer_event(event_data, 0, delay)
+            return None
+
+        status_code, item_statuses = self.send_events(events)
+        retry_after = self.get_retry_after()
+
+        # if the consumer didn't speak to each event, or the whole
+        # request failed, every event gets the overall status
+        if item_statuses is None or \
+           not (status_code and 200 <= status_code < 300):
+            item_statuses = [status_code] * len(events)
+
+        for event_data, item_status in zip(events, item_statuses):
+            self.handle_status(event_data, item_status,
+                               retry_after=retry_after)
+
+            # once we're gone the rest of the events are moot
+            if item_status == 410:
+                break
+
+        return status_code
+
+    def handle_status(self, event_data, status_code,
+                            attempts=0, retry_after=None):
+        """
+        takes action on the event based on the status code the
+        consumer gave it. attempts is how many times the event has
+        already been retried, 0 if it came fresh off the queue
+        """
+
+        event_name = event_data.get('_name')
+
+        delivered_events.inc(self.metric_labels +
+                             (get_status_class(status_code),))
+
+        # check the status code
+
+        # if it's 410 (gone) than we want to remove the subscriber
+        if status_code and status_code == 410:
+            # will cancel retry as part of removing
+            self.count_stat('removed')
+            removed_subscriptions.inc(self.metric_labels)
+            self.remove_subscription()
+
+        # we want to retry if we get a 500 series error, or if we
+        # had an unknown exception (didn't get a status code)
+        elif not status_code or status_code in (500,503,504):
+            self.count_stat('retried')
+            retried_events.inc(self.metric_labels)
+            self.schedule_retry(event_data, attempts, retry_after)
+
+        # a 200 is success, verify that we've send the msg
+        elif 200 <= status_code < 300:
+            self.count_stat('delivered')
+            if not attempts:
+                self.verify_event_processed(event_name, event_data)
+
+        # if the status code didn't get caught already
+        # than we don't want to retry. Not sure what the best action
+        # would be here, maybe wait a super long retry time to give
+        # them recovery time?
+        else:
+            self.count_stat('rejected')
+            if not attempts:
                 self.cancel_retry(event_name, event_data)
-                self.fail_sleep()
 
+    def count_stat(self, name, amount=1):
+        """
+        bumps one of our delivery stats
+        """
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def get_retry_after(self):
+        """
+        returns the seconds the consumer asked us to wait before
+        retrying (503 Retry-After) or None
+        """
+        response = self.producer.last_response
+        if response is None or response.status_code != 503:
+            return None
+        return self.retry_scheduler.parse_retry_after(
+                response.headers.get('Retry-After'))
+
+    def schedule_retry(self, event_data, attempts=0, retry_after=None):
+        """
+        hands the event to the retry scheduler to be sent again
+        later, freeing us up to keep sending other events
+        """
+
+        # we may have tried enough
+        if self.max_retry_attempts is not None and \
+           attempts >= self.max_retry_attempts:
+            print 'giving up on event: %s' % event_data
+        else:
+            delay = self.retry_scheduler.get_delay(attempts, retry_after)
+            self.retry_scheduler.schedule(event_data, attempts + 1, delay)
+
+        # the scheduler owns the event now, make sure
+        # the queue doesn't hand it back to us as well
+        if not attempts:
+            self.cancel_retry(event_data.get('_name'), event_data)
 
-    def get_event(self):
+    def defer_event(self, event_data, attempts, delay):
         """
-        get the next event from the queue
+        puts the event off for delay seconds w/o counting it
+        as an attempt
+        """
+        self.count_stat('deferred')
+
+        # everything coming back from the scheduler counts as
+        # tried at least once, so we know it's off the queue
+        self.retry_scheduler.schedule(event_data, max(1, attempts), delay)
+        if not attempts:
+            self.cancel_retry(event_data.get('_name'), event_data)
+
+    def send_due_retries(self):
+        """
+        re-sends the events who's retry time has come
+        """
+        for event_data, attempts, lease in self.retry_scheduler.get_due():
+            if self.is_stopping.is_set():
+                # put it back for whoever picks up after us
+                self.retry_scheduler.schedule(event_data, attempts, 0)
+                self.finish_retry(lease)
+                continue
+            self.dispatch_event(event_data, attempts, lease)
+
+    def finish_retry(self, lease):
+        """
+        lets the retry scheduler drop a retry we've handled, by now
+        it's been delivered or scheduled again. If we die before
+        getting here the lease runs out and it's tried again
+        """
+        if lease is not None:
+            self.retry_scheduler.done(lease)
+
+    def get_wait_timeout(self):
+        """
+        how long we can wait on the queue before we'll
+        have retries due
+        """
+        next_retry_at = self.retry_scheduler.get_next_time()
+        if next_retry_at is None:
+            return self.timeout
+        return max(0.1, min(self.timeout, next_retry_at - time()))
+
+    def get_event(self, timeout=None):
+        """
+        get the next event from the queue, waiting at most
+        timeout seconds (defaults to our timeout)
         """
         raise NotImplementedError
 
@@ -112,6 +736,10 @@ class SubscriptionHandler(Thread):
         # let the other broadcaster's know our details have changed
         self.broadcast_state_change()
 
+        # the consumer is gone, don't keep sending it events
+        # while the broadcaster gets around to removing us
+        self.is_stopping.set()
+
     def remove_subscription_details(self):
         """
         removes our details from shared storage
@@ -138,20 +766,41 @@ class SubscriptionHandler(Thread):
         """
         raise NotImplementedError
 
-    def fail_sleep(self):
-        """
-        after failing to make a request we want
-        to sleep for a bit
-        """
+class DeliveryLane(Thread):
+    """
+    sends events for a subscription handler one after another,
+    a handler w/ several lanes has that many events in flight
+    """
 
-        if not self.is_stopping.is_set():
-            sleep(self.fail_sleep_time)
+    def __init__(self, handler):
+        Thread.__init__(self)
+        self.handler = handler
+        self.queue = Queue()
 
-        # make the fail sleep time longer so that if we fail again
-        # the next attempt will be later
-        self.fail_sleep_time *= 2
+        # set by the handler once it's done giving us events
+        self.is_stopping = Event()
 
-        return True
+    def run(self):
+        handler = self.handler
+
+        # keep going until we're stopping and have sent what we had
+        while not (self.is_stopping.is_set() and self.queue.empty()):
+            try:
+                event_data, attempts, queued_at, lease = \
+                        self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            queue_wait.observe(handler.metric_labels, time() - queued_at)
+
+            # each event is verified / retried on it's own
+            try:
+                handler.handle_event(event_data, attempts)
+                handler.finish_retry(lease)
+            except Exception, ex:
+                log.exception('Delivering event: %s' % event_data)
+            finally:
+                handler.in_flight.release()
 
 class ReventSubscriptionHandler(SubscriptionHandler):
     """
@@ -172,7 +821,7 @@ class ReventSubscriptionHandler(SubscriptionHandler):
         # we don't mark handled to be re-introduced to
         # the queue.
         # channel key is subscription key, auto create channel
-        self.revent = ReventClient(subscription_key,
+        self.revent = ReventClient(self.subscription_key,
                                    self.revent_filter_string,
                                    True, True,
                                    self.event_verify_timeout)
@@ -180,28 +829,51 @@ class ReventSubscriptionHandler(SubscriptionHandler):
 
     def run(self):
         self.rc = redis.Redis(REDIS_HOST)
+        self.retry_scheduler = RedisRetryScheduler(self.rc,
+                                                   self.subscription_key,
+                                                   self.retry_base_delay,
+                                                   self.retry_max_delay)
         SubscriptionHandler.run(self)
 
     def get_revent_filter_string(self):
         """
-        builds a revent regex string for event names
+        returns the revent regex string for event names
         based on the watched events for this subscription
         """
 
-        # the regex is going to be OR'd together event names
-        regex_string = '|'.join(self.enabled_events)
-        return regex_string
+        # built once when our enabled events were set, revent
+        # only puts matching events on our channel
+        return self.event_filter.filter_string
 
     # setup the filter string as a property
     revent_filter_string = property(get_revent_filter_string)
 
-    def get_event(self):
+    def get_event(self, timeout=None):
         """
         attemps to get the next event, blocking.
         returns event_data or None
         """
-        event_name, event_data = revent.get_event(block=True,
-                                                  timeout=self.timeout)
+        wait_until = time() + (timeout or self.timeout)
+        while True:
+            remaining = wait_until - time()
+            if remaining <= 0:
+                return None
+
+            event = self.revent.get_event(block=True, timeout=remaining)
+
+            # timed out waiting
+            if not event:
+                return None
+
+            event_name, event_data = event
+
+            # revent already filtered the channel, this only guards
+            # against events queued before our events changed
+            if self.event_filter.matches(event_name):
+                break
+
+            # not one we send, make sure revent doesn't hand it back
+            self.revent.verify_msg(event_name, event_data)
 
         # add the name to the event data if it's not present
         if not '_name' in event_data:
@@ -219,28 +891,33 @@ class ReventSubscriptionHandler(SubscriptionHandler):
         SubscriptionHandler.remove_subscription(self)
 
         # tell revent to remove our event channel
-        revent.remove_channel()
+        self.revent.remove_channel()
 
     def remove_subscription_details(self):
 
-        # remove our subscription details from redis
-        key = '%s:subscription:%s:enabled_events' % (NS,self.subscription_key)
-        rc.del(KEY)
+        # our subscription is the endpoint's enabled events, clear
+        # them through the endpoint so it's event index stays in line.
+        # once the change is broadcast the broadcaster drops us
+        endpoint = RedisEndpoint.get(self.subscription_key)
+        endpoint.enabled_events = []
+
+        # we won't be retrying anything for a subscription that's gone
+        self.retry_scheduler.clear()
 
     def broadcast_state_change(self):
         """
         broadcasts on redis pubsub that our subscription details have changed
         """
 
-        rc.publish('%s:subscription_change' % NS,
-                   self.subscription_key)
+        self.rc.publish('%s:subscription_change' % NS,
+                        self.subscription_key)
 
     def verify_event_processed(self, event_name, event_data):
         """
         notifies that we have finished processing the event and it
         should not be requeued
         """
-        return revent.verify_msg(event_name, event_data)
+        return self.revent.verify_msg(event_name, event_data)
 
     def cancel_retry(self, event_name, event_data):
         """
@@ -252,6 +929,76 @@ class ReventSubscriptionHandler(SubscriptionHandler):
         return self.verify_event_processed(event_name, event_data)
 
 
+class SubscriptionChangeListener(Thread):
+
+    """
+    listens for subscription change broadcasts,
+    puts the details on the change queue
+    """
+
+    def __init__(self, is_stopping, change_queue):
+        self.change_queue = change_queue
+        self.is_stopping = is_stopping
+        Thread.__init__(self)
+
+    def run(self):
+        """
+        blocks, listening to subscription change broadcasts
+        and adding change details to queue
+        """
+
+        while not self.is_stopping.is_set():
+
+            # _listen method will block until it gets a msg
+            for msg_data in self._listen_subscription_change():
+
+                # skip (un)subscribe confirmations
+                if msg_data.get('type') != 'message':
+                    continue
+
+                # get the subscription key from the msg
+                subscription_key = msg_data.get('data')
+
+                # anything we have cached for it is stale
+                self.invalidate(subscription_key)
+
+                # put the details on our queue, w/ when we heard
+                # so the broadcaster can tell how far behind it is
+                self.change_queue.put((subscription_key, time()))
+
+    def _listen_subscription_change(self):
+        # do this yourself
+        raise NotImplementedError
+
+    def invalidate(self, subscription_key):
+        """
+        drops any local copies of the subscription's data
+        """
+        pass
+
+class RedisSubscriptionChangeListener(SubscriptionChangeListener):
+
+    def __init__(self, *args, **kwargs):
+        SubscriptionChangeListener.__init__(self,*args,**kwargs)
+
+        # our redis clients
+        self.rc = None
+        self.rc_pubsub = None
+
+    def run(self):
+        self.rc = redis.Redis(REDIS_HOST)
+        self.rc_pubsub = self.rc.pubsub()
+        self.rc_pubsub.subscribe('%s:subscription_change' % NS)
+        SubscriptionChangeListener.run(self)
+
+    def _listen_subscription_change(self):
+        return self.rc_pubsub.listen()
+
+    def invalidate(self, subscription_key):
+        # our subscriptions are endpoints
+        record_cache.invalidate(subscription_key)
+
+
 class Broadcaster:
     """
     broadcasts events to consumers
@@ -267,9 +1014,17 @@ class Broadcaster:
     #  subscriber changes
 
     sleep_time = 2
-
-    SubscriptionChangeListener = SubscriptionChangeListener
-    SubscriptionHandler = SubscriptionHandler
+    # how long to wait for more changes to come in after
+    # one does, so that a burst of changes is one sync
+    change_coalesce_time = 0.5
+    # how often to sync all the subscriptions (seconds)
+    full_sync_interval = 60 * 10
+    # where we serve /metrics, None to not serve them
+    metrics_host = '127.0.0.1'
+    metrics_port = 9102
+
+    SubscriptionChangeListener = RedisSubscriptionChangeListener
+    SubscriptionHandler = ReventSubscriptionHandler
 
     def __init__(self, domain='defaultdomain'):
 
@@ -282,6 +1037,10 @@ class Broadcaster:
         # subscriber handler
         self.subscriber_lookup = {}
 
+        # delivery stats of the handlers we've destroyed, so
+        # our totals never go backwards
+        self.retired_stats = {}
+
         # flag so that we can co-ordinate threads stopping
         self.is_stopping = Event()
 
@@ -292,6 +1051,44 @@ class Broadcaster:
         # us to subscriber detail changes
         self.subscription_change_thread = None
 
+        # serves our metrics, if we are
+        self.metrics_server = None
+
+    def start_metrics_server(self):
+        """
+        starts serving our metrics over http in the background
+        """
+
+        if not self.metrics_port:
+            return
+
+        handler_threads.set_function(self.count_handler_threads)
+
+        try:
+            self.metrics_server = MetricsServer(self.metrics_port,
+                                                self.metrics_host)
+            self.metrics_server.start()
+        except Exception, ex:
+            # we can still broadcast w/o them
+            print 'Exception starting metrics server: %s' % ex
+            self.metrics_server = None
+
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def count_handler_threads(self):
+        """
+        returns our live handler and lane threads, for the gauge
+        """
+        count = 0
+        for handler in self.subscriber_lookup.values():
+            if handler.is_alive():
+                count += 1
+            count += len([l for l in handler.lanes if l.is_alive()])
+        return {(): count}
+
     def start_subscription_change_listener(self):
         """
         starts a thread which will listen for broadcasts
@@ -320,25 +1117,125 @@ class Broadcaster:
 
         # there is going to be a subscription for each endpoint
         # start off by going through all the endpoints
+        seen_keys = set()
         for endpoint in self.get_endpoints():
+            seen_keys.add(endpoint.key)
+            self.reconcile_handler(endpoint.key, endpoint)
 
-            handler = self.subscription_lookup.get(endpoint.key)
+        # anything we are handling which no longer has an
+        # endpoint needs to go
+        for key in set(self.subscriber_lookup) - seen_keys:
+            self.reconcile_handler(key, None)
 
-            # if we don't have a handler, we need to start one
-            if not handler:
-                self.create_handler(endpoint)
+    def sync_subscription_handler(self, key):
+        """
+        bring the handler for a single subscription in to
+        line w/ the shared data store
+        """
+        self.reconcile_handler(key, self.get_endpoint(key))
+
+    def reconcile_handler(self, key, endpoint):
+        """
+        creates, restarts or destroys the subscription's handler
+        to match the endpoint (None if it's gone)
+        """
+
+        handler = self.subscriber_lookup.get(key)
+
+        # no where to send events, no events to send, or
+        # it's some one else's to handle
+        if endpoint is None or not endpoint.url or \
+           not endpoint.enabled_events or \
+           not self.owns_subscription(key):
+            if handler:
+                self.destroy_handler(key, handler)
+
+        # if we don't have a handler, we need to start one
+        elif not handler:
+            self.create_handler(endpoint)
+
+        # if we have a handler, check it's properties
+        # against what our endpoint's data says
+        elif handler.consumer_url != endpoint.url or \
+             handler.enabled_events != endpoint.enabled_events or \
+             not handler.is_alive():
+
+            # kill the handler off
+            self.destroy_handler(key, handler)
+
+            # start it again
+            self.create_handler(endpoint)
+
+    def get_stats(self):
+        """
+        returns dict of our handler count and the totals of our
+        handlers' delivery stats, including those since destroyed
+        """
+        stats = dict(self.retired_stats)
+        stats['handlers'] = len(self.subscriber_lookup)
+        for handler in self.subscriber_lookup.values():
+            with handler.stats_lock:
+                for name, value in handler.stats.iteritems():
+                    stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def owns_subscription(self, key):
+        """
+        True if this broadcaster should be handling the subscription
+        """
+        return True
+
+    def tick(self):
+        """
+        called each time around the main loop
+        """
+        pass
+
+    def get_subscription_changes(self):
+        """
+        returns the set of subscription keys which have changed,
+        waiting up to sleep_time for the first change and than
+        coalescing any others which come in right behind it
+        """
 
-            # if we have a handler, check it's properties
-            # against what our endpoint's data says
-            elif handler.consumer_url != endpoint.url or \
-                 handler.enabled_events = endpoint.enabled_events:
+        try:
+            changes = [self.subscription_change_queue.get(
+                                timeout=self.sleep_time)]
+        except Empty:
+            return set()
+
+        coalesce_until = time() + self.change_coalesce_time
+        while True:
+            remaining = coalesce_until - time()
+            if remaining <= 0:
+                break
+            try:
+                changes.append(self.subscription_change_queue.get(
+                                timeout=remaining))
+            except Empty:
+                break
 
-                # kill the handler off
-                self.destroy_handler(endpoint.key, handler)
+        # the changes are about to be synced
+        now = time()
+        for key, heard_at in changes:
+            change_lag.observe((), now - heard_at)
 
-                # start it again
-                self.create_handler(endpoint)
+        return set(key for key, heard_at in changes)
 
+    def get_endpoint(self, key):
+        """
+        returns the endpoint for the key or None if it's gone
+        """
+        endpoint = RedisEndpoint.get_cached(key)
+        if not endpoint.url:
+            return None
+        return endpoint
+
+    def get_endpoints(self):
+        """
+        lazily yields all the endpoints, each is a subscription
+        """
+        return RedisEndpoint.get_all(prefetch=True)
 
     def destroy_handler(self, key, handler):
         """
@@ -346,7 +1243,13 @@ class Broadcaster:
         """
         handler.is_stopping.set()
         handler.join()
-        del self.subscription_lookup[key]
+        del self.subscriber_lookup[key]
+
+        # keep what it delivered in our totals
+        with handler.stats_lock:
+            for name, value in handler.stats.iteritems():
+                self.retired_stats[name] = \
+                        self.retired_stats.get(name, 0) + value
         return True
 
     def create_handler(self, endpoint):
@@ -362,8 +1265,9 @@ class Broadcaster:
                                            endpoint.enabled_events,
                                            self.domain)
 
-        # add it to the lookup
-        self.subscription_lookup[endpoint.key] = handler
+        # add it to the lookup and start it up
+        self.subscriber_lookup[endpoint.key] = handler
+        handler.start()
         return handler
 
     def run(self):
@@ -371,16 +1275,29 @@ class Broadcaster:
         starts server, threads and all
         """
 
+        # let us be scraped
+        self.start_metrics_server()
+
         # setup a thread for handling subscription change broadcasts
         self.start_subscription_change_listener()
 
         # spin up handlers for each of our subscriptions
         self.sync_subscription_handlers()
 
-        # now put the master thread in a loop
+        # now put the master thread in a loop, keeping the handlers
+        # for the subscriptions which changed in sync. Every so often
+        # we'll sync them all in case we missed a change
+        last_full_sync = time()
         try:
             while not self.is_stopping.is_set():
-                sleep(self.sleep_time)
+                self.tick()
+
+                for key in self.get_subscription_changes():
+                    self.sync_subscription_handler(key)
+
+                if time() - last_full_sync >= self.full_sync_interval:
+                    self.sync_subscription_handlers()
+                    last_full_sync = time()
         except KeyboardInterrupt, ex:
             pass
         except Exception, ex:
@@ -390,75 +1307,24 @@ class Broadcaster:
             # stop all our threads
             self.stop_subscription_change_listener()
             self.stop_subscription_handlers()
+            self.stop_metrics_server()
 
 
     def stop_subscription_handlers(self):
         # stop all our handlers
         print 'stopping handlers'
-        for key, handler in self.subscription_lookup.iteritems():
+        for key, handler in self.subscriber_lookup.iteritems():
             try:
                 handler.is_stopping.set()
                 handler.join()
             except Exception, ex:
-                log.exception('Stoppiong handler: %s' % handler.key)
+                log.exception('Stopping handler: %s' % key)
 
     def stop_subscription_change_listener(self):
-        self.subscription_change_listener.is_stopping.set()
+        # we share the stop flag w/ the listener
+        self.is_stopping.set()
         # force kill if it's still listening (blocking socket)
         try:
-            self.subscription_change_listener._Thread__stop()
+            self.subscription_change_thread._Thread__stop()
         except Exception, ex:
             log.exception('Stopping subscription change listener')
-
-
-class SubscriptionChangeListener(Thread):
-
-    """
-    listens for subscription change broadcasts,
-    puts the details on the change queue
-    """
-
-    def __init__(self, is_stopping, change_queue):
-        self.change_queue = change_queue
-        self.is_stopping = is_stopping
-        Thread.__init__(self)
-
-    def run(self):
-        """
-        blocks, listening to subscription change broadcasts
-        and adding change details to queue
-        """
-
-        while not self.is_stopping.is_set():
-
-            # _listen method will block until it gets a msg
-            for msg_data in self._listen_subscription_change():
-
-                # get the subscription key from the msg
-                subscription_key = msg_data.get('data')
-
-                # put the details on our queue
-                self.change_queue.push(subscription_key)
-
-    def _listen_subscription_change(self):
-        # do this yourself
-        raise NotImplementedError
-
-class RedisSubscriptionChangeListener(SubscriptionChangeListener):
-
-    def __init__(self, *args, **kwargs):
-        SubscriptionChangeListener.__init__(self,*args,**kwargs)
-
-        # our redis clients
-        self.rc = None
-        self.rc_pubsub = None
-
-    def run(self):
-        self.rc = redis.Redis(REDIS_HOST)
-        self.rc_pubsub = self.rc.pubsub()
-        self.rc_pubsub.subscribe('%s:subscription_change' % NS)
-        SubscriptionChangeListener.run(self)
-
-    def _listen_subscription_change(self):
-        return self.rcps.listen()
-
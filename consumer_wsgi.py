@@ -1,5 +1,16 @@
 import web
 import json
+import re
+from urlparse import parse_qsl
+from threading import Thread, Lock
+from Queue import Queue, Full
+
+# use the faster json decoder if it's around
+try:
+    import ujson
+    json_loads = ujson.loads
+except ImportError:
+    json_loads = json.loads
 
 
 def validate_event_data(event_data):
@@ -15,6 +26,64 @@ def validate_event_data(event_data):
             break
     return valid
 
+def parse_query_string(query_string):
+    """
+    parses a query string / form body in one pass, returning
+    dict of attributes. Keys which show up more than once
+    have a list of their values
+    """
+    to_return = {}
+    for k, v in parse_qsl(query_string, keep_blank_values=True):
+        k = k.decode('utf-8', 'replace')
+        v = v.decode('utf-8', 'replace')
+        if k not in to_return:
+            to_return[k] = v
+        elif isinstance(to_return[k], list):
+            to_return[k].append(v)
+        else:
+            to_return[k] = [to_return[k], v]
+    return to_return
+
+class EventRejected(Exception):
+    """
+    raised by handlers which can't take the event right now,
+    the consumer answers w/ the status (and Retry-After)
+    """
+
+    def __init__(self, status=503, retry_after=None):
+        Exception.__init__(self, status)
+        self.status = status
+        self.retry_after = retry_after
+
+    def status_line(self):
+        return {413: '413 Request Entity Too Large',
+                429: '429 Too Many Requests',
+                503: '503 Service Unavailable'}.get(self.status,
+                                                    str(self.status))
+
+class LimitedInput:
+    """
+    wraps a request body stream, refusing (413) to read
+    past max_size bytes of it
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise EventRejected(413)
+        return data
+
+    def read(self, *args):
+        return self._count(self.stream.read(*args))
+
+    def readline(self, *args):
+        return self._count(self.stream.readline(*args))
+
 class Handler:
     """
     Handles the event data
@@ -25,6 +94,162 @@ class Handler:
     def __call__(self, event_data, **kwargs):
         print 'HANDLER: %s' % event_data
 
+class EventRouter(Handler):
+    """
+    Handler which passes each event on to the handler registered
+    for it's name. Handlers can be registered for an exact name,
+    a name prefix or a regex. Exact names win, than the prefixes
+    and regexes in the order they were added.
+    Events no route matches go to the default handler, if any
+    """
+
+    # python's re can only handle 100 groups in one regex, each
+    # route takes one plus however many groups it has itself
+    max_groups_per_regex = 99
+
+    def __init__(self, default_handler=None):
+        self.default_handler = default_handler
+        # event name => handler
+        self.exact_routes = {}
+        # list of (regex string, handler)
+        self.regex_routes = []
+        # list of (compiled regex, [handlers by group #])
+        self.compiled_routes = None
+
+    def add_route(self, handler, name=None, prefix=None, pattern=None):
+        """
+        routes events w/ the exact name, name starting w/ the
+        prefix, or name matching the regex pattern to the handler
+        """
+        assert [name, prefix, pattern].count(None) == 2, \
+               "One of name, prefix or pattern Required"
+
+        if name is not None:
+            self.exact_routes[name] = handler
+        elif prefix is not None:
+            self.regex_routes.append((re.escape(prefix) + '.*', handler))
+        else:
+            # a bad pattern should fail here, not on the first event
+            re.compile(pattern)
+            self.regex_routes.append((pattern, handler))
+
+        # need to recompile
+        self.compiled_routes = None
+        return handler
+
+    def compile(self):
+        """
+        combines the regex routes in to as few regexes as we can,
+        each route a group so a single match tells us which it was
+        """
+        # split the routes in to chunks w/ no more groups
+        # than a regex can take
+        chunks = []
+        chunk = []
+        chunk_groups = 0
+        for route_regex, handler in self.regex_routes:
+            groups = 1 + re.compile(route_regex).groups
+            if chunk and chunk_groups + groups > self.max_groups_per_regex:
+                chunks.append(chunk)
+                chunk = []
+                chunk_groups = 0
+            chunk.append((route_regex, handler))
+            chunk_groups += groups
+        if chunk:
+            chunks.append(chunk)
+
+        compiled_routes = []
+        for routes in chunks:
+
+            # a route alone doesn't need a group to tell it apart,
+            # which leaves room for one w/ as many groups as re allows
+            if len(routes) == 1:
+                route_regex, handler = routes[0]
+                compiled_routes.append((re.compile('^(?:%s)$' % route_regex),
+                                        {None: handler}))
+                continue
+
+            regex = '|'.join('(%s)' % r for r, h in routes)
+            # the route's groups may have groups of their own,
+            # find each route's group number
+            handlers = {}
+            group = 1
+            for route_regex, handler in routes:
+                handlers[group] = handler
+                group += 1 + re.compile(route_regex).groups
+            compiled_routes.append((re.compile('^(?:%s)$' % regex),
+                                    handlers))
+        self.compiled_routes = compiled_routes
+
+    def get_handler(self, name):
+        """
+        returns the handler for the event name or the default
+        """
+
+        # most events are routed by name
+        handler = self.exact_routes.get(name)
+        if handler:
+            return handler
+
+        if self.compiled_routes is None:
+            self.compile()
+
+        for regex, handlers in self.compiled_routes:
+            match = regex.match(name)
+            if match:
+                # a route on it's own
+                if None in handlers:
+                    return handlers[None]
+                # the route's group closes last, so it's the
+                # last index even if it has groups of it's own
+                return handlers[match.lastindex]
+
+        return self.default_handler
+
+    def __call__(self, event_data, **kwargs):
+        handler = self.get_handler(event_data.get('_name') or '')
+        if handler:
+            handler(event_data, **kwargs)
+
+class HandlerDispatcher:
+    """
+    Runs an event handler on a pool of worker threads, fed
+    from a bounded queue of events
+    """
+
+    def __init__(self, event_handler, workers=4, max_queue_depth=1000):
+        self.event_handler = event_handler
+        self.queue = Queue(max_queue_depth)
+        self.workers = []
+        for i in xrange(workers):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, event_data, **kwargs):
+        """
+        queues the event for the handler, returns False
+        if the queue is full
+        """
+        try:
+            self.queue.put_nowait((event_data, kwargs))
+            return True
+        except Full:
+            return False
+
+    def work(self):
+        while True:
+            event_data, kwargs = self.queue.get()
+            try:
+                self.event_handler(event_data, **kwargs)
+            except Exception, ex:
+                print 'exception handling event: %s %s' % (event_data, ex)
+
+# WebConsumer class => it's dispatcher
+_dispatchers = {}
+_dispatchers_lock = Lock()
+
 class WebConsumer:
     """
     Web based application for receiving events.
@@ -33,6 +258,51 @@ class WebConsumer:
 
     event_handler = Handler()
 
+    # biggest request body we'll parse (bytes)
+    max_body_size = 1024 * 256
+
+    # if async_dispatch, valid events are queued for a pool of
+    # handler workers and we answer 202 right away. If the queue
+    # is full we answer 503, asking them to retry after a bit
+    async_dispatch = False
+    handler_workers = 4
+    max_queue_depth = 1000
+    queue_full_retry_after = 5
+
+    def get_dispatcher(self):
+        """
+        returns the handler dispatcher for our class,
+        starting it if need be
+        """
+        cls = self.__class__
+        dispatcher = _dispatchers.get(cls)
+        if dispatcher:
+            return dispatcher
+
+        with _dispatchers_lock:
+            dispatcher = _dispatchers.get(cls)
+            if not dispatcher:
+                dispatcher = HandlerDispatcher(self.event_handler,
+                                               self.handler_workers,
+                                               self.max_queue_depth)
+                _dispatchers[cls] = dispatcher
+
+        return dispatcher
+
+    def handle_event(self, event_data, **kwargs):
+        """
+        passes the event to our handler, or queues it for the
+        handler workers. returns the status for the event
+        """
+
+        if not self.async_dispatch:
+            self.event_handler(event_data, **kwargs)
+            return 200
+
+        if not self.get_dispatcher().submit(event_data, **kwargs):
+            raise EventRejected(503, self.queue_full_retry_after)
+        return 202
+
     def POST(self,**kwargs):
         try:
             return self.parse_event(post=True,**kwargs)
@@ -50,24 +320,37 @@ class WebConsumer:
     def parse_event(self,get=False,post=False,**kwargs):
 
         # get event data (POST or GET)
-        event_data = self._get_event_data(get=get,post=post)
+        try:
+            event_data = self._get_event_data(get=get,post=post)
+        except EventRejected, ex:
+            # too big to take
+            web.ctx.status = ex.status_line()
+            return ''
 
-        print 'got event data: %s' % event_data
+        # a JSON array is a batch of events
+        if isinstance(event_data, list):
+            return self.parse_events(event_data, **kwargs)
 
         # validate the event data
-        is_valid = validate_event_data(event_data)
-
-        print 'is valid: %s' % is_valid
+        is_valid = isinstance(event_data, dict) and \
+                   validate_event_data(event_data)
 
         # if it's not valid, return an error
         if not is_valid:
             # the data isn't acceptable, 406
             web.notacceptable()
+            return ''
 
         # now we know we have valid event data
         # pass it off to our handler
         try:
-            self.event_handler(event_data, **kwargs)
+            if self.handle_event(event_data, **kwargs) == 202:
+                web.ctx.status = '202 Accepted'
+        except EventRejected, ex:
+            # the handler can't take it right now, try again later
+            web.ctx.status = ex.status_line()
+            if ex.retry_after is not None:
+                web.header('Retry-After', str(ex.retry_after))
         except Exception, ex:
             # client error
             web.badrequest()
@@ -78,43 +361,110 @@ class WebConsumer:
 
         return ''
 
+    def parse_events(self, events, **kwargs):
+        """
+        handles a batch of events, returning the status
+        for each event as a JSON list in the same order
+        """
+
+        statuses = []
+        for event_data in events:
+
+            # each event is validated on it's own
+            if not isinstance(event_data, dict) or \
+               not validate_event_data(event_data):
+                statuses.append(406)
+                continue
+
+            # one bad event doesn't fail the others
+            try:
+                statuses.append(self.handle_event(event_data, **kwargs))
+            except EventRejected, ex:
+                statuses.append(ex.status)
+            except Exception, ex:
+                statuses.append(400)
+
+        web.header('Content-Type','application/json')
+        return json.dumps(statuses)
+
     def _get_event_data(self, get=False, post=False):
         """
         Parses event data from either POST or GET
         returns dictionary of attributes
         """
 
-        # TODO: make more pretty
+        env = web.ctx.env
+        content_type = env.get('CONTENT_TYPE', '')
 
-        # TODO: not have to go through the input
-        #       fixing the list part
-        to_return = {}
+        # refuse what's too big before any of it is parsed
+        self._check_content_length()
 
         # see if what we have is json
-        if 'json' in web.ctx.env.get('CONTENT_TYPE',''):
+        if 'json' in content_type:
             # the POST body should be json
-            to_return = json.loads(web.data())
-
             # since it's json no cleanup needed
-            return to_return
+            return json_loads(self._read_body())
+
+        # files and such, let web.py deal w/ it
+        if 'multipart' in content_type:
+            return self._get_multipart_event_data()
+
+        # the GET params, and for a POST the form body as well
+        to_return = parse_query_string(env.get('QUERY_STRING', ''))
+        if post:
+            to_return.update(parse_query_string(self._read_body()))
+
+        return to_return
+
+    def _read_body(self):
+        """
+        returns the request body, refusing (413) bodies
+        bigger than max_body_size before reading them
+        """
+
+        self._check_content_length()
+
+        # no length up front (chunked), check once read
+        body = web.data()
+        if len(body) > self.max_body_size:
+            raise EventRejected(413)
+
+        return body
+
+    def _check_content_length(self):
+        """
+        refuses (413) the request if it says it's body is
+        bigger than max_body_size
+        """
+        try:
+            content_length = int(web.ctx.env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > self.max_body_size:
+            raise EventRejected(413)
+
+    def _get_multipart_event_data(self):
+        """
+        Parses event data from a multipart POST
+        returns dictionary of attributes
+        """
+
+        to_return = {}
 
-        # get the GET / POST params
-        single_request_data = web.input()
+        # web.py reads the body itself, w/o a length up front
+        # (chunked) cap what it can read as it goes
+        env = web.ctx.env
+        if not env.get('CONTENT_LENGTH') and \
+           not isinstance(env.get('wsgi.input'), LimitedInput):
+            env['wsgi.input'] = LimitedInput(env['wsgi.input'],
+                                             self.max_body_size)
 
         # web.py will only use the first value of a multi
         # value set unless the default passed to input is a list
-        # to get around this we are going to re-get the input list
-        # with all keys defaulting to lists and see if we get back
-        # anything values in a list w/ multiple values
-        args = dict(((k,[]) for k in single_request_data.keys()))
-        multi_value_request_data = web.input(**args)
-
-        # now compare the values from each, if the value in the
-        # multi is a list w/ multiple values than we want to keep the multiple
-        # values, if it's not we want to remove the list
-        srd = single_request_data
-        mvrd = multi_value_request_data
-        for k,v in mvrd.iteritems():
+        # so we default all the keys to lists and unwrap the
+        # ones which only have a single value
+        args = dict(((k,[]) for k in web.input().keys()))
+        for k,v in web.input(**args).iteritems():
             if isinstance(v,list) and len(v) == 1:
                 to_return[k] = v[0]
             elif isinstance(v,list) and len(v) > 1:
@@ -6,6 +6,10 @@ from redis_helpers import *
 
 NS = 'entity_tracking'
 
+# process wide cache of hydrated objs, whoever is watching
+# for changes to the objs' data needs to invalidate it
+record_cache = RecordCache()
+
 # TODO: rename
 class M(object):
     @classmethod
@@ -15,10 +19,73 @@ class M(object):
         return i
 
     @classmethod
-    def get_all(cls):
-        key_pattern = '%s:%s:*'
-        keys = rc.keys(key_pattern)
-        return [cls.get(k) for k in keys]
+    def load(cls, key):
+        """
+        returns the obj in a unit of work, w/ it's data read
+        once and changes held until save
+        """
+        return cls.get(key).begin()
+
+    def begin(self):
+        """
+        starts a unit of work, reading our data in. changes
+        to our attributes are held until we save
+        """
+        return begin(self)
+
+    def save(self):
+        """
+        writes all our held changes at once, raises
+        ConflictError if someone else changed them first
+        """
+        return save(self)
+
+    @classmethod
+    def get_cached(cls, key):
+        """
+        returns the hydrated obj from the process's record cache,
+        reading it from redis if it's not there. Don't write to it,
+        other readers share it
+        """
+        return record_cache.get(cls, key)
+
+    @classmethod
+    def get_many(cls, keys):
+        """
+        returns objs for each of the keys w/ all their
+        data loaded in one round trip
+        """
+        return get_many(cls, keys)
+
+    @classmethod
+    def get_all(cls, page_size=100, prefetch=False):
+        """
+        lazily yields every obj of the class, reading their
+        keys from the class's member set page_size at a time.
+        if prefetch the objs come hydrated a page at a time
+        """
+        if not prefetch:
+            for key in iter_member_keys(cls, page_size):
+                yield cls.get(key)
+            return
+
+        page = []
+        for key in iter_member_keys(cls, page_size):
+            page.append(key)
+            if len(page) >= page_size:
+                for obj in cls.get_many(page):
+                    yield obj
+                page = []
+        for obj in cls.get_many(page):
+            yield obj
+
+    @classmethod
+    def rebuild_members(cls, page_size=100):
+        """
+        scans redis for existing objs of the class, adding
+        them to the class's member set
+        """
+        rebuild_members(cls, page_size)
 
 class Entity(M):
 
@@ -84,8 +151,20 @@ class RedisEndpoint(Endpoint):
         self.key = None
 
     name = property(*redis_attr('name'))
-    url = property(*redis_attr('url')
-    enabled_events = property(*redis_set('enabled_events'))
+    url = property(*redis_attr('url'))
+
+    # we keep a reverse index of which endpoints have each
+    # event enabled @ <NS>:event:<event name>:endpoints
+    enabled_events = property(*redis_indexed_set('enabled_events',
+                                                  'event', 'endpoints'))
     entity = property(*redis_assoc('entity_key',RedisEntity))
 
+    @classmethod
+    def get_for_event(cls, event_name):
+        """
+        returns the endpoints which have the event enabled
+        """
+        keys = get_indexed_keys(cls, 'event', event_name, 'endpoints')
+        return [cls.get(k) for k in keys]
+
 
@@ -0,0 +1,217 @@
+from threading import Lock
+from time import time
+
+# keeps us from piling on to consumers which are struggling.
+# every consumer url gets a circuit breaker, which stops sends to
+# a consumer that keeps failing and lets a single probe through
+# once it's had time to recover, and a rate limiter which adapts
+# how fast we send (AIMD) to the latency and status codes we see.
+# both are shared by everything in the process sending to the url.
+
+
+class CircuitBreaker:
+    """
+    closed: sends go through
+    open: consumer is failing, no sends until reset_timeout passes
+    half open: one probe send goes through, it's result
+               closes or re-opens the circuit
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        # how many failures in a row open the circuit
+        self.failure_threshold = failure_threshold
+        # seconds to wait once open before probing
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_out = False
+        self.lock = Lock()
+
+    def allow(self):
+        """
+        returns True if a send should go through
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            # time to see if they're back ?
+            if self.state == self.OPEN and \
+               time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_out = False
+
+            # only one probe at a time
+            if self.state == self.HALF_OPEN and not self.probe_out:
+                self.probe_out = True
+                return True
+
+            return False
+
+    def get_retry_delay(self):
+        """
+        seconds until we'll let a send through again
+        """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.opened_at + self.reset_timeout - time())
+
+    def release(self):
+        """
+        a send we allowed didn't go out after all
+        """
+        with self.lock:
+            # let another probe through
+            if self.state == self.HALF_OPEN:
+                self.probe_out = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_out = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            # a failed probe, or too many failures, opens us up
+            if self.state == self.HALF_OPEN or \
+               self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time()
+                self.probe_out = False
+
+
+class AdaptiveRateLimiter:
+    """
+    paces sends to a rate which grows additively while the
+    consumer keeps up and is cut multiplicatively when it
+    fails or slows down
+    """
+
+    def __init__(self, initial_rate=10.0, min_rate=0.5, max_rate=1000.0,
+                       increase=1.0, decrease=0.5,
+                       slowdown=2.0, baseline_weight=0.1):
+        # sends per second
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # added to the rate after each good send
+        self.increase = increase
+        # rate is multiplied by this after a bad send
+        self.decrease = decrease
+        # sends this many times slower than the consumer's usual
+        # latency count as bad
+        self.slowdown = slowdown
+        # the consumer's usual latency (seconds), a moving average
+        # of it's good sends, w/ each send weighted baseline_weight
+        self.baseline = None
+        self.baseline_weight = baseline_weight
+
+        self.next_send_at = 0
+        self.lock = Lock()
+
+    def reserve(self, max_wait=None):
+        """
+        reserves the next send slot, returns how many seconds
+        the caller has to wait before sending. If that's more than
+        max_wait the slot is left for someone else
+        """
+        with self.lock:
+            now = time()
+            send_at = max(now, self.next_send_at)
+            if max_wait is None or send_at - now <= max_wait:
+                self.next_send_at = send_at + 1.0 / self.rate
+            return send_at - now
+
+    def is_slow(self, latency, target_latency):
+        """
+        True if the send took long enough to count as bad. A send is
+        slow if it took longer than target_latency and slowdown times
+        the consumer's usual latency, so consumers which are always
+        slow aren't held to a fixed limit. target_latency of None
+        means latency never counts against the consumer
+        """
+        if target_latency is None:
+            return False
+        limit = target_latency
+        if self.baseline is not None:
+            limit = max(limit, self.baseline * self.slowdown)
+        return latency > limit
+
+    def record(self, latency, ok, target_latency=1.0):
+        """
+        adjusts the rate based on how the send went
+        """
+        with self.lock:
+            if ok and not self.is_slow(latency, target_latency):
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            else:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+
+            # failures don't tell us how fast the consumer usually is
+            if ok:
+                if self.baseline is None:
+                    self.baseline = latency
+                else:
+                    self.baseline += self.baseline_weight * \
+                                     (latency - self.baseline)
+
+
+class FlowControl:
+    """
+    the breaker and rate limiter for one consumer url
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.limiter = AdaptiveRateLimiter()
+
+    @staticmethod
+    def is_failure(status_code):
+        """
+        True if the status code means the consumer is struggling
+        (no response, a server error, or asking us to slow down)
+        """
+        return not status_code or status_code >= 500 or status_code == 429
+
+    def record(self, latency, status_code, target_latency=1.0):
+        """
+        updates the breaker and rate w/ the result of a send.
+        target_latency is the sender's, see AdaptiveRateLimiter
+        """
+        failed = self.is_failure(status_code)
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        self.limiter.record(latency, not failed, target_latency)
+
+
+# consumer url => FlowControl
+_flow_controls = {}
+_flow_controls_lock = Lock()
+
+def get_flow_control(consumer_url):
+    """
+    returns the process wide flow control for the consumer url
+    """
+    flow_control = _flow_controls.get(consumer_url)
+    if flow_control:
+        return flow_control
+
+    with _flow_controls_lock:
+        flow_control = _flow_controls.get(consumer_url)
+        if not flow_control:
+            flow_control = FlowControl()
+            _flow_controls[consumer_url] = flow_control
+
+    return flow_control
@@ -0,0 +1,61 @@
+# runs the broadcaster w/ all of its subscription handlers
+# multiplexed on a single gevent event loop instead of one
+# OS thread per subscription.
+#
+# we monkey patch before anything else gets imported so that
+# threading, sleep and sockets are all cooperative. That makes
+# the handler "threads" greenlets, and both the Producer's HTTP
+# requests and revent's blocking queue reads yield to the loop
+# while they wait on the network.
+#
+# one loop runs per process, to use more cores run one of these
+# per core
+
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.lock import BoundedSemaphore
+
+import broadcaster
+
+
+class GreenSubscriptionHandler(broadcaster.ReventSubscriptionHandler):
+    """
+    subscription handler which runs as a greenlet, sharing
+    a cap on how many sends can be in flight at once
+    """
+
+    # with thousands of handlers on one loop they can all be
+    # waiting on the same consumer host, give the pool some room
+    http_pool_size = 100
+
+    # most sends which can be out at once across all handlers
+    # keeps us from running out of file descriptors
+    max_concurrent_sends = 1000
+    _send_slots = None
+
+    def send_event(self, event_data):
+        """
+        waits for a free send slot before pushing the event
+        """
+
+        # all the green handlers share the same slots
+        cls = GreenSubscriptionHandler
+        if cls._send_slots is None:
+            cls._send_slots = BoundedSemaphore(self.max_concurrent_sends)
+
+        with cls._send_slots:
+            return broadcaster.ReventSubscriptionHandler.send_event(
+                    self, event_data)
+
+
+class GreenBroadcaster(broadcaster.Broadcaster):
+    """
+    broadcaster which runs every subscription on one event loop
+    """
+
+    SubscriptionHandler = GreenSubscriptionHandler
+
+
+if __name__ == '__main__':
+    GreenBroadcaster().run()
@@ -0,0 +1,36 @@
+# serves the web bridge from gevent's WSGI server, each request
+# runs in a greenlet rather than holding a thread.
+#
+# long-polls and Server-Sent Event streams sit on a request for as
+# long as the client is waiting, under web.py's threaded server each
+# one ties up a worker. Here they just wait on the loop.
+#
+# we monkey patch before anything else gets imported so that the
+# redis client's blocking reads (BLPOP etc) yield to the loop
+#
+#   python green_web_bridge.py [port]
+
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pywsgi import WSGIServer
+import sys
+
+import web_bridge_wsgi
+
+
+def serve(port=8080, host='0.0.0.0'):
+    """
+    serves the web bridge until interrupted
+    """
+    server = WSGIServer((host, port),
+                        web_bridge_wsgi.application.wsgifunc())
+    print 'serving web bridge on %s:%s' % (host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt, ex:
+        pass
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -0,0 +1,305 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from bisect import bisect_left
+from itertools import count
+from threading import Thread, Lock, local
+
+# counters, gauges and histograms we can keep on in production and
+# serve up in the prometheus text format.
+#
+# recording has to be cheap, it happens on every send. Each metric
+# splits it's values across a few stripes, each w/ it's own lock, and
+# a thread only ever touches the stripe it's handed the first time it
+# records. threads are handed the stripes in turn, so they don't
+# wait on each other to record, and the stripes are only merged when
+# someone asks for the metrics.
+#
+# label values are passed as a tuple in the order the metric's
+# label names were given, ex:
+#   events = registry.counter('events_total', 'events sent', ('url',))
+#   events.inc(('http://example.com/',))
+
+# how many stripes each metric's values are split across
+STRIPES = 16
+
+# thread idents are aligned addresses, hashing them piles every
+# thread on to the same stripe. Instead each thread is handed the
+# next stripe the first time it records and keeps it
+_next_stripe = count()
+_thread_stripe = local()
+
+def get_stripe_index():
+    """
+    returns the index of the current thread's stripe
+    """
+    index = getattr(_thread_stripe, 'index', None)
+    if index is None:
+        index = _thread_stripe.index = _next_stripe.next() % STRIPES
+    return index
+
+# seconds, good for http requests
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value):
+    return unicode(value).replace('\\', '\\\\') \
+                         .replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value))
+                             for name, value in zip(names, values))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    a named metric, it's values are kept per set of label values
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # each stripe is a lock and a dict of label values => value
+        self.stripes = [(Lock(), {}) for i in xrange(STRIPES)]
+
+    def get_stripe(self):
+        """
+        returns the current thread's stripe
+        """
+        return self.stripes[get_stripe_index()]
+
+    def collect(self):
+        """
+        returns a list of (label values, value), merged
+        across the stripes
+        """
+        raise NotImplementedError
+
+    def expose(self):
+        """
+        returns the metric's lines in the text format
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for label_values, value in sorted(self.collect()):
+            lines.append('%s%s %s' % (self.name,
+                                      format_labels(self.labels,
+                                                    label_values),
+                                      format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    a count which only goes up
+    """
+
+    type = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        lock, values = self.get_stripe()
+        with lock:
+            values[label_values] = values.get(label_values, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for lock, values in self.stripes:
+            with lock:
+                values = values.items()
+            for label_values, value in values:
+                totals[label_values] = totals.get(label_values, 0) + value
+        return totals.items()
+
+
+class Gauge(Metric):
+    """
+    a value which goes up and down. Either set directly or,
+    if it's given a function, read from it when collected
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def set_function(self, function):
+        """
+        function returns a dict of label values => value
+        """
+        self.function = function
+
+    def set(self, label_values=(), value=0):
+        # last write wins, there's nothing to add up
+        lock, values = self.stripes[0]
+        with lock:
+            values[label_values] = value
+
+    def collect(self):
+        if self.function is not None:
+            return self.function().items()
+        lock, values = self.stripes[0]
+        with lock:
+            return values.items()
+
+
+class Histogram(Metric):
+    """
+    counts observations in to buckets, along w/ their sum
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, label_values=(), value=0):
+        # which bucket, the last is +Inf
+        i = bisect_left(self.buckets, value)
+        lock, values = self.get_stripe()
+        with lock:
+            counts = values.get(label_values)
+            if counts is None:
+                # a count per bucket, than the sum
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                values[label_values] = counts
+            counts[i] += 1
+            counts[-1] += value
+
+    def collect(self):
+        totals = {}
+        for lock, values in self.stripes:
+            with lock:
+                values = [(k, list(v)) for k, v in values.iteritems()]
+            for label_values, counts in values:
+                total = totals.get(label_values)
+                if total is None:
+                    totals[label_values] = counts
+                else:
+                    for i, count in enumerate(counts):
+                        total[i] += count
+        return totals.items()
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        label_names = self.labels + ('le',)
+        for label_values, counts in sorted(self.collect()):
+
+            # buckets are cumulative in the text format
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                                    counts[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (
+                        self.name,
+                        format_labels(label_names,
+                                      label_values + (format_value(bound),)),
+                        cumulative))
+
+            labels = format_labels(self.labels, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          format_value(counts[-1])))
+            lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    the metrics we expose
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self):
+        """
+        returns all the metrics in the prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return (u'\n'.join(lines) + u'\n').encode('utf8')
+
+# the process's metrics
+registry = MetricsRegistry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    # set on the subclass the server uses
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would drown out everything else
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(Thread):
+    """
+    serves the registry's metrics at /metrics
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=registry):
+        Thread.__init__(self)
+        self.daemon = True
+
+        served = registry
+        class handler(MetricsRequestHandler):
+            registry = served
+
+        # bind now so the caller finds out if the port's taken
+        self.server = ThreadingHTTPServer((host, port), handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
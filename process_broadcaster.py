@@ -0,0 +1,196 @@
+from multiprocessing import Process, Event, Queue, cpu_count
+from Queue import Empty
+from time import time, sleep
+import sys
+
+import broadcaster
+from sharded_broadcaster import HashRing
+
+# runs the broadcaster across several worker processes, one per
+# core by default, so delivery isn't stuck behind a single GIL.
+# each worker runs the handlers for the subscriptions which hash
+# to it. The parent watches over the workers, restarting any that
+# die, and collects their stats.
+
+
+class WorkerBroadcaster(broadcaster.Broadcaster):
+    """
+    broadcaster which only handles it's share of the subscriptions,
+    run inside one of the pool's worker processes
+    """
+
+    # how often we report our stats to the parent (seconds)
+    stats_interval = 10
+
+    def __init__(self, worker_index, worker_count,
+                       pool_is_stopping, stats_queue, *args, **kwargs):
+        broadcaster.Broadcaster.__init__(self, *args, **kwargs)
+
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+
+        # workers can't share a port, each serves it's own
+        # metrics on the port after the last worker's
+        if self.metrics_port:
+            self.metrics_port += worker_index
+
+        # the parent sets this to shut all the workers down
+        # we pass it on to our own flag
+        self.pool_is_stopping = pool_is_stopping
+
+        self.stats_queue = stats_queue
+        self.last_stats_at = 0
+
+    def owns_subscription(self, key):
+        return HashRing.hash(key) % self.worker_count == self.worker_index
+
+    def tick(self):
+        if self.pool_is_stopping.is_set():
+            self.is_stopping.set()
+
+        if time() - self.last_stats_at < self.stats_interval:
+            return
+        self.last_stats_at = time()
+        self.stats_queue.put((self.worker_index, self.get_stats()))
+
+
+def run_worker(worker_index, worker_count, is_stopping, stats_queue,
+               broadcaster_args):
+    """
+    entry point for worker processes
+    """
+    worker = WorkerBroadcaster(worker_index, worker_count,
+                               is_stopping, stats_queue,
+                               *broadcaster_args)
+    worker.run()
+
+
+class ProcessPoolBroadcaster:
+    """
+    forks worker processes which each broadcast a
+    subset of the subscriptions, and supervises them
+    """
+
+    # how often we check on the workers (seconds)
+    sleep_time = 2
+    # how long to wait for workers to stop before killing them
+    stop_timeout = 30
+
+    def __init__(self, worker_count=None, *broadcaster_args):
+
+        # one worker per core unless told otherwise
+        self.worker_count = worker_count or cpu_count()
+        self.broadcaster_args = broadcaster_args
+
+        # shared w/ the workers
+        self.is_stopping = Event()
+        self.stats_queue = Queue()
+
+        # index => worker process
+        self.workers = {}
+
+        # index => latest stats reported by the worker
+        self.worker_stats = {}
+
+        # totals reported by workers which have since died, so
+        # our totals never go backwards
+        self.retired_stats = {}
+
+    def start_worker(self, worker_index):
+        """
+        forks the worker for the index
+        """
+        worker = Process(target=run_worker,
+                         args=(worker_index, self.worker_count,
+                               self.is_stopping, self.stats_queue,
+                               self.broadcaster_args))
+        worker.daemon = True
+        worker.start()
+        self.workers[worker_index] = worker
+        return worker
+
+    def supervise_workers(self):
+        """
+        restarts any workers which have died
+        """
+        for worker_index, worker in self.workers.items():
+            if worker.is_alive() or self.is_stopping.is_set():
+                continue
+            print 'worker %s died (%s), restarting' % (worker_index,
+                                                       worker.exitcode)
+            self.retire_stats(worker_index)
+            self.start_worker(worker_index)
+
+    def retire_stats(self, worker_index):
+        """
+        folds the dead worker's last reported totals in to ours.
+        whatever it did since it last reported is lost
+        """
+        stats = self.worker_stats.pop(worker_index, None) or {}
+        for name, value in stats.iteritems():
+            # a count of what it was running, not a total
+            if name == 'handlers':
+                continue
+            self.retired_stats[name] = \
+                    self.retired_stats.get(name, 0) + value
+
+    def collect_stats(self):
+        """
+        takes in the stats the workers have reported
+        """
+        while True:
+            try:
+                worker_index, stats = self.stats_queue.get_nowait()
+            except Empty:
+                break
+            self.worker_stats[worker_index] = stats
+
+    def get_stats(self):
+        """
+        returns the totals of the workers' latest stats
+        """
+        totals = dict(self.retired_stats)
+        totals['workers'] = len([w for w in self.workers.values()
+                                 if w.is_alive()])
+        for stats in self.worker_stats.values():
+            for name, value in stats.iteritems():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def run(self):
+        """
+        starts the workers and watches over them until stopped
+        """
+
+        for worker_index in xrange(self.worker_count):
+            self.start_worker(worker_index)
+
+        try:
+            while not self.is_stopping.is_set():
+                sleep(self.sleep_time)
+                self.collect_stats()
+                self.supervise_workers()
+        except KeyboardInterrupt, ex:
+            pass
+        except Exception, ex:
+            print 'Top Exception: %s' % ex
+
+        finally:
+            self.stop_workers()
+
+    def stop_workers(self):
+        """
+        tells the workers to stop, killing any who don't in time
+        """
+        print 'stopping workers'
+        self.is_stopping.set()
+        stop_by = time() + self.stop_timeout
+        for worker in self.workers.values():
+            worker.join(max(0, stop_by - time()))
+            if worker.is_alive():
+                worker.terminate()
+
+
+if __name__ == '__main__':
+    worker_count = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    ProcessPoolBroadcaster(worker_count).run()
@@ -1,11 +1,37 @@
+import json
+import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from threading import Lock, Thread, Event
+from time import time
+from urlparse import urlparse
 
 class Producer:
     """
     Facilitates sending events to consumers
     """
 
-    def __init__(self, url=None, domain=None, method="POST", send_json=False):
+    # http sessions are pooled per consumer host and shared
+    # across every producer in the process, so that we aren't
+    # opening a new connection for each event we send.
+    # key is (scheme, host, port, pool size, keep alive), so
+    # producers w/ different connection settings don't end up
+    # on each other's session. value is the session
+    _sessions = {}
+    _sessions_lock = Lock()
+
+    # how many connections to keep open to each host
+    pool_size = 10
+    # re-use connections between requests ?
+    keep_alive = True
+    # seconds to wait establishing the connection / for a response
+    connect_timeout = 5
+    read_timeout = 30
+
+    def __init__(self, url=None, domain=None, method="POST", send_json=False,
+                       pool_size=None, keep_alive=None,
+                       connect_timeout=None, read_timeout=None):
         """
         Allow setting default values
         """
@@ -14,6 +40,18 @@ class Producer:
         self.method = method
         self.send_json = send_json
         self.last_http_response = None
+        # the full response from our last request
+        self.last_response = None
+
+        # connection settings, default to the class's
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
 
     def send_event(self, url=None, data={}, name=None, domain=None,
                          method="POST", send_json=False):
@@ -31,8 +69,58 @@ class Producer:
         self.last_http_response = r
         return r
 
-    @staticmethod
-    def _send_event(url, data={}, name=None, domain=None,
+    def send_events(self, events, url=None, domain=None):
+        """
+        Sends a batch of events in a single HTTP request.
+        returns the status code and a list of the per event
+        status codes (None if the consumer didn't give them)
+        """
+
+        r = self._send_events(url or self.url,
+                              events,
+                              domain or self.domain)
+
+        self.last_http_response = r[0]
+        return r
+
+    def get_session(self, url):
+        """
+        returns the shared http session for the url's host and our
+        connection settings, creating it if this is the first request
+        """
+
+        parsed = urlparse(url)
+        pool_key = (parsed.scheme, parsed.hostname, parsed.port,
+                    self.pool_size, bool(self.keep_alive))
+
+        session = self._sessions.get(pool_key)
+        if session:
+            return session
+
+        with self._sessions_lock:
+
+            # someone may have beat us to it
+            session = self._sessions.get(pool_key)
+            if session:
+                return session
+
+            # build a session who's connection pool is
+            # sized for the number of handlers sharing it
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size)
+            session.mount('%s://' % parsed.scheme, adapter)
+
+            # if we aren't keeping connections alive let
+            # the consumer know we're done after each request
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+
+            self._sessions[pool_key] = session
+
+        return session
+
+    def _send_event(self, url, data={}, name=None, domain=None,
                     method="POST", send_json=False):
         """
         Sends an event to consumer using either POST or GET
@@ -54,15 +142,418 @@ class Producer:
         headers = {}
 
         # if we are posting we can use JSON
-        if method.lower() == 'POST':
+        if method.lower() == 'post':
             if send_json:
                 data = json.dumps(data)
                 headers['Content-Type'] = 'application/json'
             else:
                 headers['Content-Type'] = 'application/x-www-form-urlencoded'
 
-        # make our HTTP request
-        r = getattr(requests,method.lower())(url, data=data, headers=headers)
+        # GET sends the event data as query params
+        if method.lower() == 'get':
+            request_args = {'params': data}
+        else:
+            request_args = {'data': data}
+
+        # make our HTTP request over the host's pooled session
+        session = self.get_session(url)
+        r = session.request(method.upper(), url, headers=headers,
+                            timeout=(self.connect_timeout,
+                                     self.read_timeout),
+                            **request_args)
+        self.last_response = r
 
         # return the response status, let them take action
         return r.status_code
+
+    def _send_events(self, url, events, domain=None):
+        """
+        Sends events to consumer as a JSON array in one POST
+        """
+
+        # make sure we have all the data we need
+        assert url, "URL Required"
+        for data in events:
+            assert domain or data.get('_domain'), "Domain Required"
+            assert data.get('_name'), "Name Required"
+
+        # fill in the domain for any which don't have one
+        batch = []
+        for data in events:
+            data = dict(data)
+            if domain and not data.get('_domain'):
+                data['_domain'] = domain
+            batch.append(data)
+
+        headers = {'Content-Type': 'application/json'}
+
+        session = self.get_session(url)
+        r = session.post(url, data=json.dumps(batch), headers=headers,
+                         timeout=(self.connect_timeout,
+                                  self.read_timeout))
+        self.last_response = r
+
+        # the consumer answers w/ a list of status codes, one per event
+        # if it didn't we can only go by the overall status code
+        item_statuses = None
+        try:
+            item_statuses = r.json()
+        except ValueError:
+            pass
+
+        if not isinstance(item_statuses, list) or \
+           len(item_statuses) != len(batch):
+            item_statuses = None
+
+        return r.status_code, item_statuses
+
+
+class EventBatcher:
+    """
+    Buffers events for a producer, sending them as a batch
+    once the batch is full or has been waiting long enough.
+
+    adding an event sends the batch if it's full or overdue. To have
+    a batch go out on time when no more events are coming, start()
+    the batcher's flush thread, or poll is_due() and flush() yourself
+    """
+
+    def __init__(self, producer, batch_size=100, linger_time=0.5,
+                       on_flush=None):
+        self.producer = producer
+        # most events to send in one request
+        self.batch_size = batch_size
+        # longest an event should wait in the buffer (seconds)
+        self.linger_time = linger_time
+        # called w/ the results of the batches the flush
+        # thread sends
+        self.on_flush = on_flush
+        self.events = []
+        self.first_added_at = None
+        self.lock = Lock()
+
+        self.is_stopping = Event()
+        self.flush_thread = None
+
+    def add_event(self, data):
+        """
+        buffers the event, returns the flush results if the
+        batch filled up or was overdue, else None
+        """
+        with self.lock:
+            if not self.events:
+                self.first_added_at = time()
+            self.events.append(data)
+
+            if len(self.events) < self.batch_size and not self._is_due():
+                return None
+            events = self._take_events()
+
+        # send w/o holding the lock, others can keep adding
+        return self._send(events)
+
+    def is_due(self):
+        """
+        True if the oldest buffered event has waited long enough
+        """
+        with self.lock:
+            return self._is_due()
+
+    def _is_due(self):
+        return bool(self.events) and \
+               time() - self.first_added_at >= self.linger_time
+
+    def _take_events(self):
+        events, self.events = self.events, []
+        return events
+
+    def flush(self):
+        """
+        sends the buffered events, returns a list of
+        (event, status code) tuples
+        """
+        with self.lock:
+            events = self._take_events()
+        return self._send(events)
+
+    def _send(self, events):
+        if not events:
+            return []
+
+        status_code, item_statuses = self.producer.send_events(events)
+
+        # fall back to the overall status for every event
+        if item_statuses is None:
+            item_statuses = [status_code] * len(events)
+
+        return zip(events, item_statuses)
+
+    def start(self):
+        """
+        starts a thread which sends batches once they're due
+        """
+        self.is_stopping.clear()
+        self.flush_thread = Thread(target=self.flush_when_due)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stops the flush thread, sending whatever is buffered
+        """
+        self.is_stopping.set()
+        if self.flush_thread:
+            self.flush_thread.join(timeout)
+            self.flush_thread = None
+
+    def flush_when_due(self):
+        """
+        checks on the batch a few times per linger time,
+        sending it once it's due
+        """
+        while True:
+            stopping = self.is_stopping.wait(self.linger_time / 4.0)
+            if not stopping and not self.is_due():
+                continue
+
+            try:
+                results = self.flush()
+            except Exception, ex:
+                print 'exception flushing events: %s' % ex
+                results = []
+
+            if results and self.on_flush:
+                self.on_flush(results)
+            if stopping:
+                break
+
+
+class OutboxProducer(Producer):
+    """
+    Producer which writes events to a local append-only log and
+    delivers them from a background thread, retrying until the
+    consumer takes them. Enqueuing is just a file append, and
+    anything not yet delivered is picked back up on restart.
+
+    the log is one JSON event per line, the offset file next to it
+    holds how far in to the log we've delivered
+    """
+
+    # sleep between retries starts at retry_base_delay doubling
+    # each time up to retry_max_delay (seconds)
+    retry_base_delay = 1
+    retry_max_delay = 60 * 5
+    # once the log is fully delivered and bigger than this
+    # (bytes) we start it over
+    compact_size = 1024 * 1024 * 10
+
+    def __init__(self, outbox_path, url=None, domain=None,
+                       fsync=False, **kwargs):
+        Producer.__init__(self, url, domain, **kwargs)
+
+        self.outbox_path = outbox_path
+        self.offset_path = '%s.offset' % outbox_path
+        # fsync each event ? survives power loss, costs latency
+        self.fsync = fsync
+
+        self.write_lock = Lock()
+        self.is_stopping = Event()
+        self.has_events = Event()
+        self.drain_thread = None
+
+        self.outbox = self._open_outbox()
+
+    def _open_outbox(self):
+        """
+        opens the log for appending, closing off any line a
+        crash left half written
+        """
+        outbox = open(self.outbox_path, 'a+b')
+        outbox.seek(0, os.SEEK_END)
+        if outbox.tell():
+            outbox.seek(-1, os.SEEK_END)
+            if outbox.read(1) != '\n':
+                outbox.write('\n')
+                outbox.flush()
+        return outbox
+
+    def enqueue_event(self, data={}, name=None, domain=None, url=None,
+                            method=None, send_json=None):
+        """
+        writes the event to the outbox to be delivered
+        in the background
+        """
+
+        # fill in our defaults now so that the event
+        # goes out as it would have now
+        entry = {
+            'url': url or self.url,
+            'data': data,
+            'name': name,
+            'domain': domain or self.domain,
+            'method': method or self.method,
+            'send_json': self.send_json if send_json is None else send_json
+        }
+
+        # a bad event would never send, stopping everything behind
+        # it in the outbox. the caller finds out now instead
+        self.validate_entry(entry)
+        entry = json.dumps(entry)
+
+        with self.write_lock:
+            self.outbox.write(entry + '\n')
+            self.outbox.flush()
+            if self.fsync:
+                os.fsync(self.outbox.fileno())
+
+        # wake up the drain loop
+        self.has_events.set()
+
+    @staticmethod
+    def validate_entry(entry):
+        """
+        raises ValueError if the outbox entry couldn't be sent
+        """
+        data = entry['data'] or {}
+        if not entry['url']:
+            raise ValueError('URL Required')
+        if not (entry['domain'] or data.get('_domain')):
+            raise ValueError('Domain Required')
+        if not (entry['name'] or data.get('_name')):
+            raise ValueError('Name Required')
+        if (entry['method'] or '').lower() not in ('get', 'post'):
+            raise ValueError('Method must be GET or POST')
+
+    def start(self):
+        """
+        starts delivering the outbox in the background
+        """
+        self.is_stopping.clear()
+        self.drain_thread = Thread(target=self.drain)
+        self.drain_thread.daemon = True
+        self.drain_thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stops the background delivery, anything left in the
+        outbox is delivered when we start up again
+        """
+        self.is_stopping.set()
+        self.has_events.set()
+        if self.drain_thread:
+            self.drain_thread.join(timeout)
+
+    def read_offset(self):
+        try:
+            with open(self.offset_path) as fh:
+                return int(fh.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def write_offset(self, offset):
+        # write and swap so that a crash never leaves a bad offset
+        tmp_path = '%s.tmp' % self.offset_path
+        with open(tmp_path, 'w') as fh:
+            fh.write(str(offset))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, self.offset_path)
+
+    def drain(self):
+        """
+        delivers the outbox's events in order, waiting for
+        more when it's caught up
+        """
+
+        offset = self.read_offset()
+        reader = open(self.outbox_path, 'rb')
+
+        while not self.is_stopping.is_set():
+            reader.seek(offset)
+            line = reader.readline()
+
+            # caught up (or the line isn't finished being written)
+            if not line.endswith('\n'):
+                if self.compact(offset):
+                    reader.close()
+                    reader = open(self.outbox_path, 'rb')
+                    offset = 0
+                self.has_events.clear()
+                self.has_events.wait(1)
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print 'skipping bad outbox entry: %r' % line
+                entry = None
+
+            if entry and not self.deliver(entry):
+                # we're stopping, try it again next time
+                break
+
+            offset += len(line)
+            self.write_offset(offset)
+
+        reader.close()
+
+    def deliver(self, entry):
+        """
+        sends the outbox entry, retrying until the consumer takes
+        it. returns False if we stopped before it was sent. An entry
+        which can't be sent at all is dropped
+        """
+
+        attempts = 0
+        while not self.is_stopping.is_set():
+            try:
+                status_code = self._send_event(entry['url'],
+                                               entry['data'],
+                                               entry['name'],
+                                               entry['domain'],
+                                               entry['method'],
+                                               entry['send_json'])
+            except requests.RequestException, ex:
+                print 'exception sending outbox event: %s' % ex
+                status_code = None
+            except Exception, ex:
+                # not the network, trying again won't help. skip it
+                # rather than hold up the rest of the outbox
+                print 'dropping outbox event %r: %s' % (entry, ex)
+                return True
+
+            self.last_http_response = status_code
+
+            # the consumer is down or busy, try again in a bit
+            if not status_code or status_code >= 500 or \
+               status_code == 429:
+                delay = min(self.retry_max_delay,
+                            self.retry_base_delay * (2 ** attempts))
+                attempts += 1
+                self.is_stopping.wait(delay / 2.0 +
+                                      random.uniform(0, delay / 2.0))
+                continue
+
+            # anything else is the consumer's final answer
+            return True
+
+        return False
+
+    def compact(self, offset):
+        """
+        if everything in the outbox has been delivered and it's
+        grown big, start it over. returns True if we did
+        """
+        if offset < self.compact_size:
+            return False
+
+        with self.write_lock:
+            # make sure nothing was written since we looked
+            self.outbox.seek(0, os.SEEK_END)
+            if self.outbox.tell() != offset:
+                return False
+            # if we die in between we'll re-send, not lose events
+            self.write_offset(0)
+            self.outbox.truncate(0)
+
+        return True
@@ -1,8 +1,15 @@
 
 import redis
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+
 rc = redis.Redis('localhost')
 
-from functools import partial
+class ConflictError(Exception):
+    """
+    someone else changed the obj's data since we read it
+    """
 
 # helper methods for setting attributes on objs
 # as redis backed data
@@ -23,16 +30,68 @@ def get_key(origin_instance):
 
     return key
 
+def get_members_key(origin):
+    """
+    returns the key for the set of all the keys of the
+    origin's class. origin can be the class or an instance
+    <NS>:members:<obj name> = set(obj keys)
+    """
+
+    namespace = origin.NS
+    if namespace:
+        key = '%s:' % namespace
+    else:
+        key = ''
+    key += 'members:%s' % origin.object_name
+
+    return key
+
+def iter_member_keys(cls, page_size=100):
+    """
+    lazily walks the keys of all the class's objs, page_size
+    at a time, w/o blocking redis
+    """
+    return rc.sscan_iter(get_members_key(cls), count=page_size)
+
+def rebuild_members(cls, page_size=100):
+    """
+    walks the keyspace (SCAN, not KEYS) for the class's objs
+    adding each to the class's member set. For data written
+    before the member set was kept
+    """
+
+    # keys look like <NS>:<obj name>:<obj key>[:<sub key>]
+    if cls.NS:
+        prefix = '%s:%s:' % (cls.NS, cls.object_name)
+    else:
+        prefix = '%s:' % cls.object_name
+    members_key = get_members_key(cls)
+
+    for key in rc.scan_iter(match='%s*' % prefix, count=page_size):
+        obj_key = key[len(prefix):].split(':', 1)[0]
+        if obj_key:
+            rc.sadd(members_key, obj_key)
+
 
 def _redis_assoc_setter(hash_key,
                         origin_instance,
                         to_assoc_instance):
 
+    # in a unit of work we hold the write until save
+    if _track_write(origin_instance, 'hash', hash_key,
+                    to_assoc_instance.key):
+        return
+
     # get our redis key
     key = get_key(origin_instance)
 
-    # set the value
-    rc.hset(key,hash_key,to_assoc_instance.key)
+    # set the value, making sure we're a known member
+    pipe = rc.pipeline()
+    pipe.hset(key,hash_key,to_assoc_instance.key)
+    pipe.sadd(get_members_key(origin_instance), origin_instance.key)
+    pipe.execute()
+
+    _update_prefetched_hash(origin_instance, hash_key, to_assoc_instance.key)
 
 def _redis_assoc_getter(hash_key,
                         to_assoc_class,
@@ -42,7 +101,11 @@ def _redis_assoc_getter(hash_key,
     key = get_key(origin_instance)
 
     # get the other objects key
-    assoc_key = rc.hget(key,hash_key)
+    prefetched = getattr(origin_instance, '_redis_hash', None)
+    if prefetched is not None:
+        assoc_key = prefetched.get(hash_key)
+    else:
+        assoc_key = rc.hget(key,hash_key)
 
     # return an instance of it
     return to_assoc_class.get(assoc_key)
@@ -62,6 +125,10 @@ def redis_assoc(hash_key, to_assoc_class):
 
 def _redis_set_setter(key_piece, instance, to_set):
 
+    # in a unit of work we hold the write until save
+    if _track_write(instance, 'set', key_piece, to_set):
+        return
+
     # get the instance's redis key
     key = get_key(instance)
 
@@ -71,9 +138,13 @@ def _redis_set_setter(key_piece, instance, to_set):
     # set the set (clearing first)
     pipe = rc.pipeline()
     pipe.delete(key)
-    pipe.sadd(key,*to_set)
+    if to_set:
+        pipe.sadd(key,*to_set)
+    pipe.sadd(get_members_key(instance), instance.key)
     pipe.execute()
 
+    _update_prefetched_set(instance, key_piece, to_set)
+
 def _redis_set_getter(key_piece, instance):
 
     # get the instance's redis key
@@ -83,6 +154,9 @@ def _redis_set_getter(key_piece, instance):
     key += ':%s' % key_piece
 
     # return the set
+    prefetched = getattr(instance, '_redis_sets', None)
+    if prefetched is not None and key_piece in prefetched:
+        return set(prefetched[key_piece])
     return rc.smembers(key)
 
 def redis_set(subkey):
@@ -95,13 +169,103 @@ def redis_set(subkey):
         partial(_redis_set_setter, subkey)
     )
 
+def get_index_key(origin_instance, index_name, member, index_piece):
+    """
+    returns the key for a reverse index set
+    <NS>:<index name>:<member>:<index piece> = set(obj keys)
+    """
+
+    namespace = origin_instance.NS
+    if namespace:
+        key = '%s:' % namespace
+    else:
+        key = ''
+    key += '%s:%s:%s' % (index_name, member, index_piece)
+
+    return key
+
+def _redis_indexed_set_setter(key_piece, index_name, index_piece,
+                              instance, to_set):
+
+    # in a unit of work we hold the write until save
+    if _track_write(instance, 'set', key_piece, to_set,
+                    (index_name, index_piece)):
+        return
+
+    # get the instance's redis key
+    key = get_key(instance)
+
+    # add our piece to the key
+    key += ':%s' % key_piece
+
+    # we walk it more than once
+    to_set = set(to_set)
+
+    def update(pipe):
+        # see what we are replacing so we can pull
+        # ourself out of those members' indexes
+        old_set = pipe.smembers(key)
+
+        pipe.multi()
+        for member in old_set:
+            pipe.srem(get_index_key(instance, index_name,
+                                    member, index_piece),
+                      instance.key)
+
+        # set the set (clearing first)
+        pipe.delete(key)
+        if to_set:
+            pipe.sadd(key, *to_set)
+
+        # add ourself to each member's index
+        for member in to_set:
+            pipe.sadd(get_index_key(instance, index_name,
+                                    member, index_piece),
+                      instance.key)
+
+        pipe.sadd(get_members_key(instance), instance.key)
+
+    # re-runs if the set changes under us
+    rc.transaction(update, key)
+
+    _update_prefetched_set(instance, key_piece, to_set)
+
+def redis_indexed_set(subkey, index_name, index_piece):
+    """
+    returns gettr/settr
+    get / set sets to redis, keeping a reverse index from
+    each member to the keys of the objs who's set has it
+    at <NS>:<index_name>:<member>:<index_piece>
+    """
+    return (
+        partial(_redis_set_getter, subkey),
+        partial(_redis_indexed_set_setter, subkey, index_name, index_piece)
+    )
+
+def get_indexed_keys(cls, index_name, member, index_piece):
+    """
+    returns the keys of the objs who's indexed set has the member
+    """
+    return rc.smembers(get_index_key(cls, index_name,
+                                     member, index_piece))
+
 def _redis_attr_setter(hash_key, instance, value):
     print 'attr setter: %s %s %s' % (hash_key, instance, value)
+    if _track_write(instance, 'hash', hash_key, value):
+        return
     key = get_key(instance)
-    return rc.hset(key, hash_key, value)
+    pipe = rc.pipeline()
+    pipe.hset(key, hash_key, value)
+    pipe.sadd(get_members_key(instance), instance.key)
+    r = pipe.execute()[0]
+    _update_prefetched_hash(instance, hash_key, value)
+    return r
 
 def _redis_attr_getter(hash_key, instance):
     print 'attr getter: %s %s' % (hash_key, instance)
+    prefetched = getattr(instance, '_redis_hash', None)
+    if prefetched is not None:
+        return prefetched.get(hash_key)
     key = get_key(instance)
     return rc.hget(key, hash_key)
 
@@ -119,19 +283,31 @@ def redis_attr(hash_key):
 def _redis_assoc_set_setter(key_piece,
                             instance,
                             to_assoc_instances):
+    if _track_write(instance, 'set', key_piece,
+                    [a.key for a in to_assoc_instances]):
+        return
     key = get_key(instance)
     key += ':%s' % key_piece
     pipe = rc.pipeline()
     pipe.delete(key)
-    pipe.sadd(key,*[a.key for a in to_assoc_instances])
+    if to_assoc_instances:
+        pipe.sadd(key,*[a.key for a in to_assoc_instances])
+    pipe.sadd(get_members_key(instance), instance.key)
     pipe.execute()
 
+    _update_prefetched_set(instance, key_piece,
+                           [a.key for a in to_assoc_instances])
+
 def _redis_assoc_set_getter(key_piece,
                             to_assoc_class,
                             instance):
-    key = get_key(instance)
-    key += ':%s' % key_piece
-    to_assoc_keys = rc.smembers(key)
+    prefetched = getattr(instance, '_redis_sets', None)
+    if prefetched is not None and key_piece in prefetched:
+        to_assoc_keys = prefetched[key_piece]
+    else:
+        key = get_key(instance)
+        key += ':%s' % key_piece
+        to_assoc_keys = rc.smembers(key)
     return set(to_assoc_class.get(k) for k in to_assoc_keys if k)
 
 def redis_assoc_set(subkey, to_assoc_class):
@@ -143,3 +319,287 @@ def redis_assoc_set(subkey, to_assoc_class):
         partial(_redis_assoc_set_getter, subkey, to_assoc_class),
         partial(_redis_assoc_set_setter, subkey)
     )
+
+# objs can be hydrated w/ all their data up front, in which case
+# the getters read from the prefetched data instead of redis
+# instance._redis_hash = {hash key: value}
+# instance._redis_sets = {key piece: set()}
+
+def _update_prefetched_hash(instance, hash_key, value):
+    # keep prefetched data in line w/ what we wrote
+    prefetched = getattr(instance, '_redis_hash', None)
+    if prefetched is not None:
+        prefetched[hash_key] = value
+
+def _update_prefetched_set(instance, key_piece, values):
+    prefetched = getattr(instance, '_redis_sets', None)
+    if prefetched is not None:
+        prefetched[key_piece] = set(values)
+
+def get_redis_fields(cls):
+    """
+    returns the hash keys and set key pieces backing
+    the class's redis properties
+    """
+
+    hash_keys = set()
+    set_pieces = set()
+    for name in dir(cls):
+        prop = getattr(cls, name, None)
+        if not isinstance(prop, property) or \
+           not isinstance(prop.fget, partial):
+            continue
+        getter = prop.fget.func
+        if getter in (_redis_attr_getter, _redis_assoc_getter):
+            hash_keys.add(prop.fget.args[0])
+        elif getter in (_redis_set_getter, _redis_assoc_set_getter):
+            set_pieces.add(prop.fget.args[0])
+
+    return hash_keys, set_pieces
+
+def get_many(cls, keys):
+    """
+    returns fully hydrated instances of the class for each
+    key, fetching all their data in one pipeline
+    """
+
+    keys = list(keys)
+    hash_keys, set_pieces = get_redis_fields(cls)
+    set_pieces = sorted(set_pieces)
+
+    # one HGETALL for the obj's attrs and one SMEMBERS for
+    # each of it's sets
+    instances = []
+    pipe = rc.pipeline(transaction=False)
+    for key in keys:
+        instance = cls.get(key)
+        instances.append(instance)
+        obj_key = get_key(instance)
+        pipe.hgetall(obj_key)
+        for key_piece in set_pieces:
+            pipe.smembers('%s:%s' % (obj_key, key_piece))
+    results = pipe.execute()
+
+    # hand the results out to the instances
+    results = iter(results)
+    for instance in instances:
+        instance._redis_hash = next(results)
+        instance._redis_sets = {}
+        for key_piece in set_pieces:
+            instance._redis_sets[key_piece] = next(results)
+
+    return instances
+
+# objs can also be put in to a unit of work. Their data is read once
+# up front, writes are held locally (dirty) and than all flushed
+# together on save. If another writer changed any of the fields we
+# are writing since we read them save raises a ConflictError
+# instance._redis_dirty = {(kind, field): (value, index)}
+
+def _track_write(instance, kind, field, value, index=None):
+    """
+    if the instance is in a unit of work holds the write for save
+    and returns True, else returns False
+    """
+    dirty = getattr(instance, '_redis_dirty', None)
+    if dirty is None:
+        return False
+
+    if kind == 'hash':
+        dirty[(kind, field)] = (value, index)
+        _update_prefetched_hash(instance, field, value)
+    else:
+        value = set(value)
+        dirty[(kind, field)] = (value, index)
+        _update_prefetched_set(instance, field, value)
+
+    return True
+
+def _snapshot(instance):
+    # remember what we read so save can tell if it's changed
+    instance._redis_loaded_hash = dict(instance._redis_hash)
+    instance._redis_loaded_sets = dict((k, set(v)) for k, v
+                                       in instance._redis_sets.iteritems())
+
+def begin(instance):
+    """
+    puts the instance in to a unit of work, reading all it's
+    data once. returns the instance
+    """
+
+    # hydrate the instance w/ it's current data
+    loaded = get_many(instance.__class__, [instance.key])[0]
+    instance._redis_hash = loaded._redis_hash
+    instance._redis_sets = loaded._redis_sets
+    _snapshot(instance)
+
+    instance._redis_dirty = {}
+    return instance
+
+def save(instance):
+    """
+    flushes the instance's held writes to redis in one
+    MULTI / EXEC. returns True if there was anything to write
+    """
+
+    dirty = getattr(instance, '_redis_dirty', None)
+    if not dirty:
+        return False
+
+    obj_key = get_key(instance)
+    set_keys = dict((field, '%s:%s' % (obj_key, field))
+                    for kind, field in dirty if kind == 'set')
+
+    pipe = rc.pipeline()
+    try:
+        # if any of these change before we exec, the exec fails
+        pipe.watch(obj_key, *set_keys.values())
+
+        # make sure no one changed what we're about to write
+        # since we read it
+        for kind, field in dirty:
+            if kind == 'hash':
+                current = pipe.hget(obj_key, field)
+                loaded = instance._redis_loaded_hash.get(field)
+            else:
+                current = pipe.smembers(set_keys[field])
+                loaded = instance._redis_loaded_sets.get(field, set())
+            if current != loaded:
+                raise ConflictError('%s %s changed' % (obj_key, field))
+
+        pipe.multi()
+
+        # all the attrs go in one write
+        hash_updates = dict((field, value) for (kind, field), (value, _)
+                            in dirty.iteritems() if kind == 'hash')
+        if hash_updates:
+            pipe.hmset(obj_key, hash_updates)
+
+        for (kind, field), (values, index) in dirty.iteritems():
+            if kind != 'set':
+                continue
+            old_values = instance._redis_loaded_sets.get(field, set())
+
+            # keep the reverse index in step
+            if index:
+                index_name, index_piece = index
+                for member in old_values:
+                    pipe.srem(get_index_key(instance, index_name,
+                                            member, index_piece),
+                              instance.key)
+                for member in values:
+                    pipe.sadd(get_index_key(instance, index_name,
+                                            member, index_piece),
+                              instance.key)
+
+            # set the set (clearing first)
+            pipe.delete(set_keys[field])
+            if values:
+                pipe.sadd(set_keys[field], *values)
+
+        pipe.sadd(get_members_key(instance), instance.key)
+        pipe.execute()
+
+    except redis.WatchError:
+        raise ConflictError('%s changed while saving' % obj_key)
+
+    finally:
+        pipe.reset()
+
+    # what we wrote is now what's in redis, which gives it back
+    # as strings, so that's how the next save has to compare it
+    for (kind, field), (value, _) in dirty.iteritems():
+        if kind == 'hash':
+            instance._redis_hash[field] = str(value)
+        else:
+            instance._redis_sets[field] = set(str(v) for v in value)
+    _snapshot(instance)
+    instance._redis_dirty = {}
+
+    return True
+
+class RecordCache(object):
+    """
+    in process LRU cache of hydrated objs. Entries are dropped
+    when they fall off the end or are invalidated (when someone
+    tells us the obj's data changed)
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        # (obj name, obj key) => hydrated instance
+        self.records = OrderedDict()
+        # names of the objs we've cached
+        self.object_names = set()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # bumped each time the key is invalidated, so a read which
+        # was in flight when it was knows not to cache what it got.
+        # the epoch covers clear() and keeps the dict from growing
+        # past max_size
+        self.generations = {}
+        self.epoch = 0
+
+    def get(self, cls, key):
+        """
+        returns the hydrated obj for the key, only reading
+        redis if we don't already have it
+        """
+
+        cache_key = (cls.object_name, key)
+        with self.lock:
+            instance = self.records.pop(cache_key, None)
+            if instance is not None:
+                # back to the front of the line
+                self.records[cache_key] = instance
+                self.hits += 1
+                return instance
+            self.misses += 1
+            generation = self.get_generation(key)
+
+        instance = get_many(cls, [key])[0]
+
+        with self.lock:
+            # it changed while we were reading, what we have may
+            # be stale. the next get will read it again
+            if self.get_generation(key) != generation:
+                return instance
+            self.records[cache_key] = instance
+            self.object_names.add(cls.object_name)
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+        return instance
+
+    def invalidate(self, key):
+        """
+        drops any obj w/ the key
+        """
+        with self.lock:
+            for object_name in self.object_names:
+                self.records.pop((object_name, key), None)
+
+            if len(self.generations) >= self.max_size:
+                self.generations.clear()
+                self.epoch += 1
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def get_generation(self, key):
+        # call holding the lock
+        return self.epoch, self.generations.get(key, 0)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.generations.clear()
+            self.epoch += 1
+
+    def get_stats(self):
+        """
+        returns dict of the cache's size and hit / miss counts
+        """
+        return {'size': len(self.records),
+                'hits': self.hits,
+                'misses': self.misses}
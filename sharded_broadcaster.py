@@ -0,0 +1,184 @@
+from bisect import bisect
+from hashlib import md5
+from threading import Thread
+from time import time
+import socket
+import os
+import sys
+import redis
+
+import broadcaster
+
+# runs a broadcaster as one of a group of nodes which split
+# the subscriptions between them. each node heartbeats in to redis,
+# and subscriptions are assigned to the live nodes by consistent
+# hashing over the endpoint key. When a node joins or dies the
+# others see the change on their next heartbeat and pick up / drop
+# the subscriptions which moved.
+#
+# to try it out start a few against a local redis:
+#   python sharded_broadcaster.py node-a
+#   python sharded_broadcaster.py node-b
+
+NS = broadcaster.NS
+
+
+class HashRing:
+    """
+    consistent hash ring, maps keys to nodes such that adding
+    or removing a node only moves the keys that node owns
+    """
+
+    # how many points each node gets on the ring, more
+    # points spread the keys more evenly
+    replicas = 100
+
+    def __init__(self, nodes=()):
+        self.nodes = set(nodes)
+        self.ring = []
+        self.ring_nodes = {}
+        self.build()
+
+    @staticmethod
+    def hash(value):
+        return long(md5(value).hexdigest()[:16], 16)
+
+    def build(self):
+        self.ring_nodes = {}
+        for node in self.nodes:
+            for i in xrange(self.replicas):
+                self.ring_nodes[self.hash('%s:%s' % (node, i))] = node
+        self.ring = sorted(self.ring_nodes)
+
+    def get_node(self, key):
+        """
+        returns the node which owns the key, None if
+        there are no nodes
+        """
+        if not self.ring:
+            return None
+        i = bisect(self.ring, self.hash(key)) % len(self.ring)
+        return self.ring_nodes[self.ring[i]]
+
+
+class RedisNodeMembership:
+    """
+    tracks the live nodes in redis. Each node heartbeats in to
+    a sorted set scored by the time of it's last heartbeat, nodes
+    which haven't been heard from in node_timeout are dead
+    """
+
+    def __init__(self, rc, node_id, node_timeout=15):
+        self.rc = rc
+        self.node_id = node_id
+        self.node_timeout = node_timeout
+        self.key = '%s:nodes' % NS
+
+    def heartbeat(self):
+        """
+        records that we're alive, returns the set of live nodes
+        """
+        now = time()
+        pipe = self.rc.pipeline(transaction=True)
+        pipe.zadd(self.key, {self.node_id: now})
+        # clear out the dead
+        pipe.zremrangebyscore(self.key, '-inf', now - self.node_timeout)
+        pipe.zrange(self.key, 0, -1)
+        return set(pipe.execute()[-1])
+
+    def leave(self):
+        """
+        removes us from the live nodes right away
+        """
+        self.rc.zrem(self.key, self.node_id)
+
+
+class ShardedBroadcaster(broadcaster.Broadcaster):
+    """
+    broadcaster which only handles the subscriptions which
+    hash to it among the live nodes
+    """
+
+    # seconds between heartbeats, and how long without one
+    # before the other nodes give up on us
+    heartbeat_interval = 5
+    node_timeout = 15
+
+    def __init__(self, node_id=None, *args, **kwargs):
+        broadcaster.Broadcaster.__init__(self, *args, **kwargs)
+
+        self.node_id = node_id or '%s:%s' % (socket.gethostname(),
+                                             os.getpid())
+        self.membership = RedisNodeMembership(
+                                redis.Redis(broadcaster.REDIS_HOST),
+                                self.node_id, self.node_timeout)
+        self.ring = HashRing()
+
+        self.heartbeat_thread = None
+
+        # join before the first sync so we own something. after that
+        # the heartbeat thread keeps the live nodes up to date
+        self.live_nodes = self.membership.heartbeat()
+        self.update_membership()
+
+    def owns_subscription(self, key):
+        return self.ring.get_node(key) == self.node_id
+
+    def update_membership(self):
+        """
+        rebuilds the ring from the live nodes, returns True
+        if they changed
+        """
+        nodes = self.live_nodes
+        if nodes == self.ring.nodes:
+            return False
+        print 'nodes changed: %s' % sorted(nodes)
+        self.ring = HashRing(nodes)
+        return True
+
+    def tick(self):
+        # rebalance when nodes come and go
+        if self.update_membership():
+            self.sync_subscription_handlers()
+
+    def run(self):
+        # heartbeat off the main loop, stopping handlers while
+        # rebalancing can block it for longer than node_timeout
+        self.heartbeat_thread = HeartbeatThread(self)
+        self.heartbeat_thread.start()
+        try:
+            broadcaster.Broadcaster.run(self)
+        finally:
+            # make sure we don't heartbeat back in after leaving
+            self.is_stopping.set()
+            self.heartbeat_thread.join()
+            # let the others pick up our subscriptions now
+            self.membership.leave()
+
+
+class HeartbeatThread(Thread):
+    """
+    heartbeats in to redis for a sharded broadcaster, keeping
+    it's live nodes up to date
+    """
+
+    def __init__(self, broadcaster):
+        Thread.__init__(self)
+        self.daemon = True
+        self.broadcaster = broadcaster
+
+    def run(self):
+        b = self.broadcaster
+        while not b.is_stopping.is_set():
+            b.is_stopping.wait(b.heartbeat_interval)
+            if b.is_stopping.is_set():
+                break
+            try:
+                b.live_nodes = b.membership.heartbeat()
+            except Exception, ex:
+                # try again next time, we have till node_timeout
+                print 'Exception heartbeating: %s' % ex
+
+
+if __name__ == '__main__':
+    ShardedBroadcaster(*sys.argv[1:2]).run()
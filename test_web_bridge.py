@@ -0,0 +1,154 @@
+# tests the web bridge's redis scripts (refcounts, overflow policies,
+# ttls, expired counts) against a live redis, they're skipped if
+# there isn't one on localhost. they use db 15 and only touch the
+# web bridge's keys
+#
+#   python -m unittest test_web_bridge
+
+import unittest
+import redis
+
+import consumer_wsgi
+import web_bridge_wsgi as wb
+
+TEST_DB = 15
+
+
+def get_test_client():
+    rc = redis.Redis('127.0.0.1', db=TEST_DB)
+    try:
+        rc.ping()
+    except redis.ConnectionError:
+        return None
+    return rc
+
+
+class LimitedBufferer(wb.RedisEventBufferer):
+
+    def __init__(self, max_length, policy, ttl=60):
+        self.limits = (max_length, policy, ttl)
+
+    def get_queue_limits(self, queue_key):
+        return self.limits
+
+
+class WebBridgeScriptsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rc = get_test_client()
+        if self.rc is None:
+            self.skipTest('no redis on localhost')
+
+        # point the bridge at our db
+        self.old = (wb.rc, wb.push_event_script, wb.pop_events_script)
+        wb.rc = self.rc
+        wb.push_event_script = self.rc.register_script(
+                                    wb.push_event_script.script)
+        wb.pop_events_script = self.rc.register_script(
+                                    wb.pop_events_script.script)
+        self.clear()
+
+        self.feeder = wb.EventFeeder()
+
+    def tearDown(self):
+        if self.rc is None:
+            return
+        self.clear()
+        wb.rc, wb.push_event_script, wb.pop_events_script = self.old
+
+    def clear(self):
+        keys = self.rc.keys('%s:*' % wb.NS)
+        if keys:
+            self.rc.delete(*keys)
+
+    def event_key(self, queue_key, i=0):
+        event_id = self.rc.lindex(wb.get_redis_key(queue_key), i)
+        return wb.get_event_key(event_id)
+
+    def pop(self, queue_key, count=10):
+        return self.feeder.get_events_data(queue_key, count)
+
+    def test_refcount(self):
+        # one copy of the data, referenced by both queues
+        bufferer = wb.RedisEventBufferer()
+        bufferer.push_to_queue({'_name': 'a'}, 'q1')
+        bufferer.push_to_queue({'_name': 'a'}, 'q2')
+        event_key = self.event_key('q1')
+        self.assertEqual(self.rc.get(event_key + ':refs'), '2')
+
+        # the data stays until the last queue lets go
+        self.assertEqual(self.pop('q1'), [{'_name': 'a'}])
+        self.assertEqual(self.rc.get(event_key + ':refs'), '1')
+        self.assertTrue(self.rc.exists(event_key))
+
+        self.assertEqual(self.pop('q2'), [{'_name': 'a'}])
+        self.assertFalse(self.rc.exists(event_key))
+        self.assertFalse(self.rc.exists(event_key + ':refs'))
+
+    def test_drop_oldest(self):
+        bufferer = LimitedBufferer(2, 'drop_oldest')
+        bufferer.push_to_queue({'_name': 'a'}, 'q')
+        oldest_key = self.event_key('q')
+        bufferer.push_to_queue({'_name': 'b'}, 'q')
+        bufferer.push_to_queue({'_name': 'c'}, 'q')
+
+        self.assertFalse(self.rc.exists(oldest_key))
+        self.assertEqual(wb.get_overflow_stats(), {'q': {'dropped': 1}})
+        self.assertEqual(self.pop('q'), [{'_name': 'b'}, {'_name': 'c'}])
+
+    def test_drop_newest(self):
+        bufferer = LimitedBufferer(2, 'drop_newest')
+        for name in 'abc':
+            bufferer.push_to_queue({'_name': name}, 'q')
+
+        self.assertEqual(wb.get_overflow_stats(), {'q': {'dropped': 1}})
+        self.assertEqual(self.pop('q'), [{'_name': 'a'}, {'_name': 'b'}])
+        # nothing left behind for the dropped event
+        self.assertEqual(self.rc.keys('%s:event:*' % wb.NS), [])
+
+    def test_reject(self):
+        bufferer = LimitedBufferer(1, 'reject')
+        bufferer.push_to_queue({'_name': 'a'}, 'q')
+        self.assertRaises(consumer_wsgi.EventRejected,
+                          bufferer.push_to_queue, {'_name': 'b'}, 'q')
+
+        self.assertEqual(wb.get_overflow_stats(), {'q': {'rejected': 1}})
+        self.assertEqual(self.pop('q'), [{'_name': 'a'}])
+
+    def test_pop_refreshes_ttls(self):
+        bufferer = wb.RedisEventBufferer()
+        bufferer.push_to_queue({'_name': 'a'}, 'q1')
+        bufferer.push_to_queue({'_name': 'a'}, 'q2')
+        event_key = self.event_key('q2')
+        self.rc.expire(event_key, 5)
+        self.rc.expire(event_key + ':refs', 5)
+
+        # q2 still holds the event, reading q1 keeps it alive
+        self.pop('q1')
+        self.assertTrue(self.rc.ttl(event_key) > 5)
+        self.assertTrue(self.rc.ttl(event_key + ':refs') > 5)
+
+    def test_push_refreshes_ttls(self):
+        bufferer = wb.RedisEventBufferer()
+        bufferer.push_to_queue({'_name': 'a'}, 'q1')
+        event_key = self.event_key('q1')
+        self.rc.expire(event_key, 5)
+
+        bufferer.push_to_queue({'_name': 'a'}, 'q2')
+        self.assertTrue(self.rc.ttl(event_key) > 5)
+
+    def test_expired_counted(self):
+        bufferer = wb.RedisEventBufferer()
+        bufferer.push_to_queue({'_name': 'a'}, 'q')
+        bufferer.push_to_queue({'_name': 'b'}, 'q')
+
+        # as if the first event's data expired
+        self.rc.delete(self.event_key('q'))
+
+        self.assertEqual(self.pop('q'), [{'_name': 'b'}])
+        self.assertEqual(wb.get_overflow_stats(), {'q': {'expired': 1}})
+        self.assertEqual(self.rc.keys('%s:event:*' % wb.NS), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,16 +3,19 @@ import web
 import consumer_wsgi
 import redis
 import json
+from hashlib import sha1
 
 rc = redis.Redis('127.0.0.1')
 
 NS = 'web_bridge'
 
-# TODO: de-dup messages, there will be a huge amount
-#       of msg duplication between subscribers
-#       this could be done in redis, keeping a reference
-#       counter and than just putting in references to
-#       the full data in the queue
+# there is a huge amount of msg duplication between subscribers
+# so each event's data is stored once, keyed by a hash of it's
+# content, along side a reference counter. The queues only hold
+# the event ids.
+#
+# <NS>:event:<event id> = event data json
+# <NS>:event:<event id>:refs = # of queues referencing the event
 
 def get_redis_key(queue_key):
     """
@@ -20,22 +23,178 @@ def get_redis_key(queue_key):
     """
     return '%s:queue:%s' % (NS, queue_key)
 
+def get_event_key(event_id):
+    """
+    returns the redis key for the given event's data
+    """
+    return '%s:event:%s' % (NS, event_id)
+
+# counts of events dropped / rejected per queue because the queue
+# was full, and of queued events who's data expired before they
+# were read
+# <NS>:dropped = {queue key: count}
+# <NS>:rejected = {queue key: count}
+# <NS>:expired = {queue key: count}
+DROPPED_KEY = '%s:dropped' % NS
+REJECTED_KEY = '%s:rejected' % NS
+EXPIRED_KEY = '%s:expired' % NS
+
+# the scripts below are passed the keys they know up front, but the
+# event data keys of ids popped off a queue are only known inside
+# the script (ARGV holds their prefix). So they are for a single
+# redis node, not redis cluster
+
+# stores the event's data (if it's not already), takes a reference
+# to it and adds it to the queue, all in one shot. If the queue is
+# full the overflow policy (ARGV[5]) decides what gives:
+#   drop_oldest: the event at the front of the queue is dropped
+#   drop_newest: this event is dropped
+#   reject: this event is dropped and we return 'rejected'
+# the idle ttl is set when the queue is created and refreshed when
+# it's read from, so queues no one is reading expire. the event's
+# data lives as long, refreshed each time it's referenced or read
+push_event_script = rc.register_script("""
+local queue_key, event_key = KEYS[1], KEYS[2]
+local dropped_key, rejected_key = KEYS[3], KEYS[4]
+local event_id, event_data = ARGV[1], ARGV[2]
+local max_length, ttl = tonumber(ARGV[3]), tonumber(ARGV[4])
+local policy, stats_field, event_prefix = ARGV[5], ARGV[6], ARGV[7]
+
+if max_length > 0 and redis.call('LLEN', queue_key) >= max_length then
+    if policy == 'reject' then
+        redis.call('HINCRBY', rejected_key, stats_field, 1)
+        return 'rejected'
+    end
+    redis.call('HINCRBY', dropped_key, stats_field, 1)
+    if policy == 'drop_newest' then
+        return 'dropped'
+    end
+    local old_id = redis.call('LPOP', queue_key)
+    local old_key = event_prefix .. old_id
+    if redis.call('DECR', old_key .. ':refs') <= 0 then
+        redis.call('DEL', old_key, old_key .. ':refs')
+    end
+end
+
+redis.call('SET', event_key, event_data)
+redis.call('INCR', event_key .. ':refs')
+redis.call('RPUSH', queue_key, event_id)
+
+if ttl > 0 then
+    if redis.call('TTL', queue_key) < 0 then
+        redis.call('EXPIRE', queue_key, ttl)
+    end
+    -- the data only needs to live as long as the queues
+    redis.call('EXPIRE', event_key, ttl)
+    redis.call('EXPIRE', event_key .. ':refs', ttl)
+end
+return 'queued'
+""")
+
+# pops up to ARGV[2] event ids off the queue (KEYS[1]) in one shot,
+# resolves them to the events' data and releases the queue's
+# reference to each (cleaning up the data if no queues reference it
+# any more). ARGV[3] is the queue's idle ttl, which we refresh since
+# it's being read, along w/ that of the data other queues still
+# reference. ARGV[4] is the queue's name, ids who's data has expired
+# are counted against it in KEYS[2]. any ARGV past that are ids
+# already popped (by BLPOP) to resolve first
+pop_events_script = rc.register_script("""
+local queue_key, expired_key = KEYS[1], KEYS[2]
+local event_prefix, ttl = ARGV[1], tonumber(ARGV[3])
+local event_ids = {}
+for i = 5, #ARGV do
+    table.insert(event_ids, ARGV[i])
+end
+local count = tonumber(ARGV[2]) - #event_ids
+if count > 0 then
+    for _, event_id in ipairs(redis.call('LRANGE', queue_key, 0, count - 1)) do
+        table.insert(event_ids, event_id)
+    end
+    redis.call('LTRIM', queue_key, count, -1)
+end
+local events = {}
+for _, event_id in ipairs(event_ids) do
+    local event_key = event_prefix .. event_id
+    local event_data = redis.call('GET', event_key)
+    if event_data then
+        table.insert(events, event_data)
+    else
+        redis.call('HINCRBY', expired_key, ARGV[4], 1)
+    end
+    if redis.call('DECR', event_key .. ':refs') <= 0 then
+        redis.call('DEL', event_key, event_key .. ':refs')
+    elseif ttl > 0 then
+        redis.call('EXPIRE', event_key, ttl)
+        redis.call('EXPIRE', event_key .. ':refs', ttl)
+    end
+end
+if ttl > 0 then
+    redis.call('EXPIRE', queue_key, ttl)
+end
+return events
+""")
+
+def get_overflow_stats():
+    """
+    returns {queue key: {'dropped': #, 'rejected': #, 'expired': #}}
+    for the queues which have overflowed or had data expire
+    """
+    stats = {}
+    for name, key in (('dropped', DROPPED_KEY), ('rejected', REJECTED_KEY),
+                      ('expired', EXPIRED_KEY)):
+        for queue_key, count in rc.hgetall(key).iteritems():
+            stats.setdefault(queue_key, {})[name] = int(count)
+    return stats
+
 class RedisEventBufferer(consumer_wsgi.Handler):
     """
     When new event data is received this handler will
     buffer into redis queue
     """
 
+    # most events a queue holds, what to do w/ events past
+    # that (drop_oldest, drop_newest, reject) and how long (seconds)
+    # a queue no one reads from lives. 0 for no limit
+    max_queue_length = 10000
+    overflow_policy = 'drop_oldest'
+    queue_ttl = 60 * 60 * 24
+    # when rejecting, the status and Retry-After we answer with
+    reject_status = 503
+    reject_retry_after = 30
+
+    def get_queue_limits(self, queue_key):
+        """
+        returns (max length, overflow policy, idle ttl) for the
+        queue, override for per queue limits
+        """
+        return self.max_queue_length, self.overflow_policy, self.queue_ttl
+
     def push_to_queue(self, event_data, queue_key):
 
-        # json encode our event data
-        print 'dumping: %s' % event_data
-        event_data_string = json.dumps(event_data)
+        # json encode our event data, the id is from it's content
+        # so the same event pushed to many queues is stored once
+        event_data_string = json.dumps(event_data, sort_keys=True)
+        event_id = sha1(event_data_string).hexdigest()
+        event_key = get_event_key(event_id)
 
-        # get our Q's key, and add our event data to queue
+        # store the data, take a reference to it and add
+        # the reference to our Q all at once, keeping in the
+        # Q's limits
         key = get_redis_key(queue_key)
-        print 'pushing to queue: %s %s' % (key,event_data_string)
-        rc.rpush(key, event_data_string)
+        max_length, policy, ttl = self.get_queue_limits(queue_key)
+        print 'pushing to queue: %s %s' % (key,event_id)
+        result = push_event_script(keys=[key, event_key,
+                                         DROPPED_KEY, REJECTED_KEY],
+                                   args=[event_id, event_data_string,
+                                         max_length, ttl, policy,
+                                         queue_key, get_event_key('')])
+
+        if result == 'dropped':
+            print 'queue full, dropped event: %s %s' % (key, event_id)
+        elif result == 'rejected':
+            raise consumer_wsgi.EventRejected(self.reject_status,
+                                              self.reject_retry_after)
 
     def __call__(self, event_data, queue_key):
         """
@@ -70,52 +229,436 @@ class EventConsumer(consumer_wsgi.WebConsumer):
 class EventFeeder:
     """
     WSGI app which will feed the events from the queue
-    back to the web client
+    back to the web client.
+
+    clients can long-poll by passing wait=<seconds>, we'll hold
+    the request until an event shows up or the time is up. Passing
+    max=<n> returns up to n events at once as a JSON array.
+    Long-polls hold their worker for the wait, so serve this from
+    a greenlet (gevent) server, see green_web_bridge.py
     """
 
+    # longest we'll hold a long-poll open (seconds)
+    max_wait = 30
+    # most events we'll return in one response
+    max_events = 100
+
     def GET(self, queue_key='DEFAULT'):
 
         print 'Feeder GET: %s' % queue_key
 
-        # get the next event data from the queue
-        # we are getting back the json string
-        event_data = self.get_event_data(queue_key,decode=False)
+        params = web.input(wait=0, max=None)
+        try:
+            wait = min(self.max_wait, max(0, int(params.wait)))
+            count = params.max and \
+                    min(self.max_events, max(1, int(params.max)))
+        except ValueError:
+            return web.badrequest()
 
-        # if we didn't receive event data we are going
-        # to return a 304 not modified
-        if not event_data:
-            print 'no queue msg, nothing found'
-            return web.notfound()
+        # get the next events' data from the queue
+        # we are getting back the json strings
+        events_data = self.get_events_data(queue_key, count or 1,
+                                           wait, decode=False)
 
         # let the client know we're piping json
         web.header('Content-Type','application/json')
 
+        # if they asked for a batch they get back a list,
+        # even if it's empty
+        if count:
+            return '[%s]' % ','.join(events_data)
+
+        # if we didn't receive event data we are going
+        # to return a 404 not found
+        if not events_data:
+            print 'no queue msg, nothing found'
+            return web.notfound()
+
         # if we did get the event data we are going
         # to return it as a json string
-        print 'got event data: %s' % event_data
-        return event_data
+        return events_data[0]
 
     def get_event_data(self, queue_key, decode=True):
         """
         Returns next event on queue if any
         """
 
-        # try and get the next msg from the queue
+        events_data = self.get_events_data(queue_key, 1, decode=decode)
+
+        # none if there was nothing in the list
+        if not events_data:
+            return None
+        return events_data[0]
+
+    def get_events_data(self, queue_key, count=1, wait=0, decode=True):
+        """
+        Returns up to count events from the queue. If the queue
+        is empty waits up to wait seconds for an event to show up
+        """
+
         key = get_redis_key(queue_key)
-        print 'checking redis: %s' % key
-        msg = rc.lpop(key)
+        popped_ids = []
 
-        if msg and decode:
-            return json.loads(msg)
+        # block until the first event is there
+        if wait:
+            popped = rc.blpop(key, timeout=wait)
+            if not popped:
+                return []
+            popped_ids.append(popped[1])
 
-        # none if there was nothing in the list
-        return msg
+        # grab the rest of the batch in one round trip
+        ttl = EventConsumer.event_handler.get_queue_limits(queue_key)[2]
+        events_data = pop_events_script(keys=[key, EXPIRED_KEY],
+                                        args=[get_event_key(''), count, ttl,
+                                              queue_key] + popped_ids)
+
+        if decode:
+            return [json.loads(e) for e in events_data]
+        return events_data
+
+
+class EventStreamer(EventFeeder):
+    """
+    WSGI app which keeps the response open, streaming events
+    to the web client as Server-Sent Events as they arrive.
+
+    each event gets an increasing id, clients which reconnect
+    w/ a Last-Event-ID are replayed what they missed from a
+    short log of recently sent events.
+    Every open stream holds a worker, so serve this from a
+    greenlet (gevent) server, see green_web_bridge.py
+    """
+
+    # how often to send a comment down an idle stream (seconds)
+    keepalive_time = 15
+    # how many sent events to keep for clients resuming
+    replay_length = 100
+    # how long to keep the replay log around once it's idle
+    replay_ttl = 60 * 60
+
+    def GET(self, queue_key='DEFAULT'):
+
+        print 'Streamer GET: %s' % queue_key
+
+        # browsers send the last id they saw when they reconnect
+        last_event_id = web.ctx.env.get('HTTP_LAST_EVENT_ID') or \
+                        web.input(last_event_id=None).last_event_id
+        try:
+            last_event_id = int(last_event_id or 0)
+        except ValueError:
+            return web.badrequest()
+
+        web.header('Content-Type','text/event-stream')
+        web.header('Cache-Control','no-cache')
+        return self.stream_events(queue_key, last_event_id)
+
+    def stream_events(self, queue_key, last_event_id=0):
+        """
+        generator yielding SSE messages for the queue's events
+        """
+
+        # catch the client up on what they missed
+        if last_event_id:
+            for event_id, event_data in self.get_replay(queue_key,
+                                                        last_event_id):
+                yield self.format_event(event_id, event_data)
+
+        while True:
+
+            # wait for the next events to come in
+            events_data = self.get_events_data(queue_key,
+                                               self.max_events,
+                                               self.keepalive_time,
+                                               decode=False)
+
+            # if nothing came in, let the client (and any proxies)
+            # know we are still here
+            if not events_data:
+                yield ': keepalive\n\n'
+                continue
+
+            # log them before sending so they can be
+            # replayed if the client drops mid send
+            for event_id, event_data in self.record_sent(queue_key,
+                                                         events_data):
+                yield self.format_event(event_id, event_data)
+
+    def format_event(self, event_id, event_data):
+        """
+        returns the SSE message for the event
+        """
+        return 'id: %s\ndata: %s\n\n' % (event_id, event_data)
+
+    def record_sent(self, queue_key, events_data):
+        """
+        gives each event an id and adds it to the queue's replay
+        log. returns list of (event id, event data)
+        """
+
+        key = get_redis_key(queue_key)
+
+        # reserve ids for all the events at once
+        last_id = rc.incrby('%s:event_id' % key, len(events_data))
+        first_id = last_id - len(events_data) + 1
+        sent = zip(range(first_id, last_id + 1), events_data)
+
+        replay_key = '%s:sent' % key
+        pipe = rc.pipeline(transaction=True)
+        pipe.lpush(replay_key, *['%s:%s' % e for e in sent])
+        pipe.ltrim(replay_key, 0, self.replay_length - 1)
+        pipe.expire(replay_key, self.replay_ttl)
+        # the ids go w/ the log, abandoned queues don't leave them
+        pipe.expire('%s:event_id' % key, self.replay_ttl)
+        pipe.execute()
+
+        return sent
+
+    def get_replay(self, queue_key, last_event_id):
+        """
+        returns list of (event id, event data) which were sent
+        after the given id, oldest first
+        """
+
+        replay_key = '%s:sent' % get_redis_key(queue_key)
+        replay = []
+        for entry in rc.lrange(replay_key, 0, -1):
+            event_id, event_data = entry.split(':', 1)
+            if int(event_id) > last_event_id:
+                replay.append((int(event_id), event_data))
+
+        # the log is newest first
+        replay.reverse()
+        return replay
+
+
+# alternatively queues can be kept in redis streams. Streams are
+# capped in length, readers in a consumer group each get their own
+# events and have to ack them (unacked events are handed back out),
+# and clients can replay the stream from the last id they saw
+#
+# <NS>:stream:<queue key> = stream of {data: event data json}
+
+def get_stream_key(queue_key):
+    """
+    returns the redis key for the given queue's stream
+    """
+    return '%s:stream:%s' % (NS, queue_key)
+
+class RedisStreamEventBufferer(consumer_wsgi.Handler):
+    """
+    When new event data is received this handler will
+    add it to the queue's redis stream
+    """
+
+    # about how many events to keep per stream, the oldest
+    # are trimmed off past this
+    max_length = 10000
+
+    def push_to_queue(self, event_data, queue_key):
+        key = get_stream_key(queue_key)
+        print 'adding to stream: %s' % key
+        rc.xadd(key, {'data': json.dumps(event_data)},
+                maxlen=self.max_length, approximate=True)
+
+    def __call__(self, event_data, queue_key):
+        self.push_to_queue(event_data, queue_key)
+
+
+class StreamEventConsumer(EventConsumer):
+    """
+    WSGI application for consuming events in to streams
+    """
+
+    event_handler = RedisStreamEventBufferer()
+
+
+class StreamEventFeeder:
+    """
+    WSGI app which feeds events from the queue's stream back to
+    the web client as a JSON array of {"id": .., "event": ..}
+
+    params:
+      max: most events to return
+      wait: seconds to wait for events if there are none
+      last_id: replay the stream from after this id, w/o a group
+      group / consumer: the consumer group to read as, and who we
+                        are in it. each client (tab) needs it's own
+                        consumer name, required unless replaying.
+                        Events read in a group need to be acked or
+                        they are handed out again, first to the same
+                        consumer and, once they've sat unacked for
+                        claim_idle_time, to any other consumer
+      ack: comma separated ids of events to ack
+    """
+
+    max_wait = 30
+    max_events = 100
+    default_group = 'default'
+    # how long (seconds) an event can sit unacked w/ one consumer
+    # before another can claim it, ex: the tab that read it closed
+    claim_idle_time = 60
+
+    # (stream key, group) we know exist, shared by every request
+    # so we aren't asking redis to create them each time
+    ensured_groups = set()
+
+    def GET(self, queue_key='DEFAULT'):
+
+        print 'Stream feeder GET: %s' % queue_key
+
+        params = web.input(wait=0, max=1, last_id=None, ack='',
+                           group=self.default_group, consumer=None)
+        try:
+            wait = min(self.max_wait, max(0, int(params.wait)))
+            count = min(self.max_events, max(1, int(params.max)))
+        except ValueError:
+            return web.badrequest()
+
+        key = get_stream_key(queue_key)
+
+        # the client is done w/ these
+        ack_ids = [i for i in params.ack.split(',') if i]
+        if ack_ids:
+            rc.xack(key, params.group, *ack_ids)
+
+        if params.last_id:
+            events = self.replay(key, params.last_id, count, wait)
+        elif not params.consumer:
+            # sharing a consumer would hand each client the
+            # others' unacked events
+            return web.badrequest()
+        else:
+            events = self.read_group(key, params.group, params.consumer,
+                                     count, wait)
+
+        web.header('Content-Type','application/json')
+        return '[%s]' % ','.join('{"id": %s, "event": %s}' % (
+                                    json.dumps(event_id), fields['data'])
+                                 for event_id, fields in events)
+
+    def replay(self, key, last_id, count, wait):
+        """
+        returns up to count (id, fields) from after last_id
+        """
+        result = rc.xread({key: last_id}, count=count,
+                          block=wait * 1000 if wait else None)
+        return result[0][1] if result else []
+
+    def read_group(self, key, group, consumer, count, wait):
+        """
+        returns up to count (id, fields) for the consumer, starting
+        w/ any it was handed before but never acked
+        """
+
+        self.ensure_group(key, group)
+
+        # anything we didn't ack last time comes first
+        try:
+            result = rc.xreadgroup(group, consumer, {key: '0'},
+                                   count=count)
+        except redis.ResponseError, ex:
+            if 'NOGROUP' not in str(ex):
+                raise
+            # the stream was deleted out from under us, w/ it's groups
+            self.ensured_groups.discard((key, group))
+            self.ensure_group(key, group)
+            result = rc.xreadgroup(group, consumer, {key: '0'},
+                                   count=count)
+        pending = self.drop_trimmed(key, group,
+                                    result[0][1] if result else [])
+        if pending:
+            return pending
+
+        # than anything another consumer read and left unacked
+        claimed = self.drop_trimmed(key, group,
+                                    self.claim_idle(key, group,
+                                                    consumer, count))
+        if claimed:
+            return claimed
+
+        result = rc.xreadgroup(group, consumer, {key: '>'}, count=count,
+                               block=wait * 1000 if wait else None)
+        return result[0][1] if result else []
+
+    def claim_idle(self, key, group, consumer, count):
+        """
+        claims up to count events for the consumer which other
+        consumers have left unacked for claim_idle_time, returns
+        their (id, fields)
+        """
+        min_idle = int(self.claim_idle_time * 1000)
+        idle_ids = [p['message_id']
+                    for p in rc.xpending_range(key, group, '-', '+', count)
+                    if p['consumer'] != consumer and
+                       p['time_since_delivered'] >= min_idle]
+        if not idle_ids:
+            return []
+
+        # only those still idle are claimed, if another
+        # consumer beat us to one it's theirs
+        claimed = [(event_id, fields) for event_id, fields in
+                   rc.xclaim(key, group, consumer, min_idle, idle_ids)
+                   if event_id]
+
+        # events trimmed off the stream can't be claimed, they'd sit
+        # pending forever. ack them, there's nothing left to deliver
+        missing = set(idle_ids) - set(event_id for event_id, f in claimed)
+        trimmed = [event_id for event_id in missing
+                   if not rc.xrange(key, event_id, event_id)]
+        if trimmed:
+            rc.xack(key, group, *trimmed)
+
+        return claimed
+
+    def drop_trimmed(self, key, group, events):
+        """
+        acks the events trimmed off the stream before they were
+        acked, they come back empty and there's nothing left to
+        deliver. returns the rest
+        """
+        trimmed = [event_id for event_id, fields in events if not fields]
+        if trimmed:
+            rc.xack(key, group, *trimmed)
+        return [(event_id, fields) for event_id, fields in events
+                if fields]
+
+    def ensure_group(self, key, group):
+        """
+        creates the consumer group, if it doesn't exist. The group
+        starts at the beginning of the stream, so the events pushed
+        before anyone read are delivered too
+        """
+        if (key, group) in self.ensured_groups:
+            return
+        try:
+            rc.xgroup_create(key, group, id='0', mkstream=True)
+        except redis.ResponseError, ex:
+            # it's already there
+            if 'BUSYGROUP' not in str(ex):
+                raise
+        self.ensured_groups.add((key, group))
+
+
+class QueueStats:
+    """
+    WSGI app reporting which queues have been dropping or
+    rejecting events because they were full, or lost events
+    who's data expired before they were read
+    """
+
+    def GET(self):
+        web.header('Content-Type','application/json')
+        return json.dumps(get_overflow_stats())
 
 
 # setup the wsgi app
 urls = (
     '/push/(.*)', 'EventConsumer',
-    '/pull/(.*)', 'EventFeeder'
+    '/pull/(.*)', 'EventFeeder',
+    '/stream/(.*)', 'EventStreamer',
+    '/streams/push/(.*)', 'StreamEventConsumer',
+    '/streams/pull/(.*)', 'StreamEventFeeder',
+    '/stats', 'QueueStats'
 )
 application = web.application(urls, globals())
 